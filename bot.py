@@ -15,6 +15,8 @@ from discord.ext import commands
 
 from ext import auth_config
 from ext import checks
+from ext import sheet
+from ext import store
 from ext import utils
 
 load_dotenv()
@@ -103,6 +105,8 @@ def load_extensions(cogs, path='cogs.'):
             logger.warning('LoadError: %s', str(e))
 
 
+# Load every application once; commands work on the resident store after this.
+store.records.load()
 load_extensions(all_extensions)
 
 
@@ -120,6 +124,8 @@ async def on_ready():
     logger.info('Connected to Discord.')
     for guild in bot.guilds:
         logger.info('Joined this guild: %s(%d)' % (guild.name, guild.id))
+    # Open the sheet without holding up anything else.
+    asyncio.ensure_future(sheet.warm_up())
 
 
 @bot.event
@@ -229,6 +235,10 @@ async def shutdown(ctx):
     '''Shut down the bot'''
     async def close():
         await bot.session.close()
+        # Push queued changes to the sheet before going offline.
+        await sheet.close()
+        # Make sure every queued application write is on disk.
+        await store.records.close()
         return await bot.logout()
 
     logger.info('Disconnected from Discord. Shutting down the bot.')
@@ -1,4 +1,5 @@
 '''Background tasks module.'''
+import asyncio
 import datetime
 import os
 import time
@@ -8,26 +9,55 @@ from discord.ext import commands, tasks
 from dotenv import load_dotenv
 
 from ext import auth_config
+from ext import deadlines
+from ext import ledger
 from ext import sheet
+from ext import store
 from ext import utils
 
 load_dotenv()
 
-TIME_FORMAT = os.getenv('TIME_FORMAT')
-# When an application is found/ready, we allow 72 hours until it is finished.
-COUNTDOWN_HOURS = int(os.getenv('COUNTDOWN_HOURS'))
+# How often the sheet is compared with the store and fixed up.
+RECONCILE_HOURS = float(os.getenv('RECONCILE_HOURS') or 6)
+# How often edits made in the sheet are pulled into the store.
+PULL_MINUTES = float(os.getenv('SHEET_PULL_MINUTES') or 5)
+# Statuses reported by monitoring, in this order.
+REPORT_STATUSES = (utils.Status.PENDING, utils.Status.FOUND,
+                   utils.Status.APPROVED, utils.Status.READY,
+                   utils.Status.PROCESSING)
+
+
+def report_delta(last, report):
+    '''Request ids that entered, left or changed in a status report.'''
+    entered = [k for k in report if k not in last]
+    left = [k for k in last if k not in report]
+    changed = [k for k in report if k in last and report[k] != last[k]]
+    return entered, left, changed
+
 
 class Background(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
-        self.last_status = dict()
         self.monitoring.start()
-        # Use loop_counter to fire a countdown monitoring when
-        # monitoring tasks are running at the same time.
-        self.loop_counter = -1
+        self.reconciling.start()
+        self.pulling.start()
+        self.countdown.start()
 
     def cog_unload(self):
         self.monitoring.cancel()
+        self.reconciling.cancel()
+        self.pulling.cancel()
+        self.countdown.cancel()
+
+    def snapshot(self):
+        '''Read the reported applications once and group them by status.
+
+        The status reports of a tick all work from this, so they agree with
+        each other.'''
+        groups = {status: [] for status in REPORT_STATUSES}
+        for app in store.records.by_status(*REPORT_STATUSES):
+            groups[app.status].append(app)
+        return groups
 
     @tasks.loop(minutes=15)
     async def monitoring(self):
@@ -37,104 +67,177 @@ class Background(commands.Cog):
         dm_chan = user.dm_channel or await user.create_dm()
         # Send message to #bot-logs channel.
         # chan = self.bot.get_channel(auth_config.SEND_MSG_CHANNELS[0])
-        staff_cog = self.bot.get_cog('Staff')
-        for status in ('pending', 'found', 'approved', 'ready', 'processing'):
-            report = await staff_cog.search(None, status, 'background')
-            title = '_%s_ Application' % status.capitalize()
+        apps = self.snapshot()
+        # Where each application is now, for the ones that left a status.
+        now_in = {app.request_id: status
+                  for status, found in apps.items() for app in found}
+        for status in REPORT_STATUSES:
+            report = {app.request_id: utils.brief(app) for app in apps[status]}
+            # Only report what is different/new since the last report; the
+            # ledger keeps it across restarts.
+            key = 'status-%s' % status.name
+            last = ledger.sent.get(key) or dict()
+            entered, left, changed = report_delta(last, report)
+            if not (entered or left or changed):
+                continue
+            await ledger.sent.mark(key, report)
+            title = '_%s_ Application' % status.name.capitalize()
             if len(report) > 1:
                 title += 's: *%d*' % len(report)
             else:
                 title += ': *%d*' % len(report)
-            if report:
-                embed = discord.Embed(title=title)
-                embed.color = utils.random_color()
-                for k, v in report.items():
-                    embed.add_field(name=k, value=v, inline=True)
-                # Save to self.last_status, and only report different/new info.
-                # "if status not in self.last_status" means this is a new status.
-                # "if report != self.last_status[status]" means data of this status
-                # has changed.
-                if status not in self.last_status or report != self.last_status[
-                        status]:
-                    self.last_status[status] = report
-                    await dm_chan.send(embed=embed)
-                    # await chan.send(embed=embed)
-        # To guarantee the first task will monitor this 'countdown' task.
-        self.loop_counter += 1
-        if (self.loop_counter % 4) == 0:
-            status = 'ready'
-            report = await staff_cog.search(None, status, 'countdown')
-            if report:
-                for req_id, details in report.items():
-                    # TODO: test only.
-                    # if 'foxfair' not in details['name']:
-                    #    break
-                    current = datetime.datetime.utcnow()
-                    for exp_min in [360, 180, 60]:
-                        app_user = self.bot.get_user(details['user_id'])
-                        # Prepare to send a DM to remind the applicant
-                        reminder_chan = app_user.dm_channel or await app_user.create_dm()
-                        then_ts = time.strptime(details['last_modified'], TIME_FORMAT)
-                        then_dt = datetime.datetime.fromtimestamp(time.mktime(then_ts))
-                        deadline = datetime.timedelta(hours=COUNTDOWN_HOURS)
-                        reminder_period = datetime.timedelta(minutes=exp_min)
-                        time_left = then_dt + deadline - current
-                        if (then_dt + deadline) <= current:
-                            user_msg = ('{} Your application ID: {}, was '
-                                        'expired after 72 hours, and it was '
-                                        'closed automatically.'.format(
-                                            app_user.mention, req_id))
-                            # Expired; closed by DreamieBot.
-                            data_dict = utils.open_requestlog()
-                            found_data = dict()
-                            for request_id, details in data_dict.items():
-                                if request_id == req_id:
-                                    details['status'] = utils.Status.CLOSED.name
-                                    # mark a last_modified timestring
-                                    tm = time.localtime(time.time())
-                                    timestring = time.strftime(TIME_FORMAT, tm)
-                                    details['last_modified'] = timestring
-                                    details['staff'] = 'DreamieBot#1424'
-                                    found_data[request_id] = details
-                            utils.flush_requestlog(data_dict)
-                            server_msg = ('DreamitBot closed an expired '
-                                          'application {} at {}'.format(
-                                                req_id, timestring))
-                            await reminder_chan.send(user_msg)
-                            await staff_cog.send_logs(server_msg)
-                            time.sleep(1)
-                            await sheet.update_data(found_data)
-                            return await sheet.archive_column(req_id)
-                        elif time_left <= reminder_period:
-                            # remove microsecond, users dont care.
-                            time_left = utils.chop_microseconds(time_left)
-                            message = ('{} Your application has been ready but '
-                                       'the timer is approaching to the {} '
-                                       'hours limit.\nRemaining time is {}.\n'
-                                       'Please use `~status` to see the details'
-                                       'and contact your staff, {}, to complete'
-                                       'your application ASAP.'.format(
-                                            app_user.mention, COUNTDOWN_HOURS,
-                                            time_left, details['staff']))
-                            self.key = 'reminder-{}-{}'.format(exp_min, user.name)
-                            # Put into self.last_status and avoid spammy messages.
-                            if self.key not in self.last_status:
-                                self.last_status[self.key] = req_id
-                                await reminder_chan.send(message)
-                                # send logs to log channel
-                                log_msg = 'Send a reminder to {}: {}'.format(
-                                            app_user.mention, self.key)
-                                await staff_cog.send_logs(log_msg)
-                        else:
-                            # debug
-                            print('current time: %s' % current)
-                            print('timer left: %s' % (then_dt+deadline-current))
+            fields = [('+ %s' % k, report[k]) for k in entered]
+            fields += [('~ %s' % k, report[k]) for k in changed]
+            for k in left:
+                moved = now_in[k].name.capitalize() if k in now_in else 'Done'
+                fields.append(('- %s' % k, '%s\nNow: %s' % (last[k], moved)))
+            description = '%d new, %d changed, %d gone since the last report.' % (
+                len(entered), len(changed), len(left))
+            await utils.send_embeds(dm_chan, utils.build_embeds(
+                title, fields, description))
+            # await utils.send_embeds(chan, ...)
 
+    @tasks.loop(seconds=0)
+    async def countdown(self):
+        '''Remind applicants of ready applications and close expired ones.
+
+        Sleeps until the next deadline is due instead of scanning on a timer.'''
+        await deadlines.timers.wait()
+        staff_cog = self.bot.get_cog('Staff')
+        due = deadlines.timers.due()
+        expired = [app for action, app in due if action == deadlines.EXPIRE]
+        if expired:
+            await self.expire(expired)
+        for action, details in due:
+            if action == deadlines.EXPIRE:
+                continue
+            req_id = details.request_id
+            mention = '<@{}>'.format(details.user_id)
+            deadline = details.modified + deadlines.COUNTDOWN_HOURS * 3600
+            time_left = datetime.timedelta(seconds=deadline - int(time.time()))
+            message = ('{} Your application has been ready but '
+                       'the timer is approaching to the {} '
+                       'hours limit.\nRemaining time is {}.\n'
+                       'Please use `~status` to see the details'
+                       'and contact your staff, {}, to complete'
+                       'your application ASAP.'.format(
+                            mention, deadlines.COUNTDOWN_HOURS,
+                            time_left, details.staff))
+            # One reminder per application and tier, unless its deadline
+            # moved; kept until an hour past the deadline.
+            key = 'reminder-{}-{}'.format(req_id, action)
+            if ledger.sent.seen(key, details.modified):
+                continue
+            await ledger.sent.mark(key, details.modified,
+                                   expires=deadline + 3600)
+            try:
+                await self.send_dm(details.user_id, message)
+            except (discord.HTTPException, AttributeError) as e:
+                # i.e. DMs closed, or the applicant left the server. One bad
+                # recipient must not stop the countdown for everyone.
+                await staff_cog.send_logs('Failed to send a reminder to {}: '
+                                          '{}'.format(mention, str(e)))
+                continue
+            # send logs to log channel
+            await staff_cog.send_logs('Send a reminder to {}: {}'.format(
+                mention, key))
+
+    async def expire(self, apps):
+        '''Close every expired application at once.
+
+        The closures are saved in one batch and reach the sheet in one sync;
+        the DMs and the staff log go out concurrently.'''
+        staff_cog = self.bot.get_cog('Staff')
+        closing = []
+        for details in apps:
+            # Closed by DreamieBot. Work on a copy, so a staff action made in
+            # the meantime wins instead of being overwritten.
+            app = details.copy()
+            app.status = utils.Status.CLOSED
+            # mark a last_modified time
+            app.touch('DreamieBot#1424')
+            closing.append(app)
+        conflicts = await store.records.update_many(closing)
+        for req_id in conflicts:
+            # Still ready maybe, with a new deadline.
+            deadlines.timers.schedule(store.records.get(req_id))
+        closed = [app for app in closing if app.request_id not in conflicts]
+        if closed:
+            sheet.queue_update({app.request_id: app.to_record()
+                                for app in closed})
+            for app in closed:
+                sheet.queue_archive(app.request_id)
+        sends = []
+        for app in closed:
+            user_msg = ('<@{}> Your application ID: {}, was expired after '
+                        '{} hours, and it was closed automatically.'.format(
+                            app.user_id, app.request_id,
+                            deadlines.COUNTDOWN_HOURS))
+            sends.append(self.send_dm(app.user_id, user_msg))
+        if closed:
+            sends.append(staff_cog.send_logs(
+                'DreamitBot closed expired applications at {}: {}'.format(
+                    closed[0].last_modified_time,
+                    ', '.join(app.request_id for app in closed))))
+        if conflicts:
+            sends.append(staff_cog.send_logs(
+                'Skipped expiring applications changed in the meantime: '
+                '{}'.format(', '.join(conflicts))))
+        results = await asyncio.gather(*sends, return_exceptions=True)
+        failed = [r for r in results if isinstance(r, Exception)]
+        if failed:
+            await staff_cog.send_logs(
+                'Failed to send %d expiry messages: %s' % (len(failed),
+                                                          str(failed[0])))
+
+    async def send_dm(self, user_id, message):
+        '''DM a user, opening the DM channel if needed.'''
+        user = self.bot.get_user(user_id)
+        dm_chan = user.dm_channel or await user.create_dm()
+        return await dm_chan.send(message)
+
+    @countdown.before_loop
+    async def before_countdown(self):
+        await self.bot.wait_until_ready()
+        deadlines.timers.rebuild()
 
     @monitoring.before_loop
     async def before_monitoring(self):
         await self.bot.wait_until_ready()
 
+    @tasks.loop(hours=RECONCILE_HOURS)
+    async def reconciling(self):
+        '''Rotate finished rows out and fix sheet drift left behind by failed
+        or partial writes.'''
+        staff_cog = self.bot.get_cog('Staff')
+        try:
+            # Take staff edits first, or the store would write over them.
+            await staff_cog.pull_sheet()
+            await sheet.flush()
+            await sheet.rotate()
+            await staff_cog.reconcile_sheet()
+        except Exception as e:
+            await staff_cog.send_logs('Failed to reconcile the sheet: %s' % str(e))
+
+    @reconciling.before_loop
+    async def before_reconciling(self):
+        await self.bot.wait_until_ready()
+        # Not right at startup, the sheet is busy warming up then.
+        await asyncio.sleep(60)
+
+    @tasks.loop(minutes=PULL_MINUTES)
+    async def pulling(self):
+        '''Pull status, staff and notes edited in the sheet into the store.'''
+        staff_cog = self.bot.get_cog('Staff')
+        try:
+            await staff_cog.pull_sheet()
+        except Exception as e:
+            await staff_cog.send_logs('Failed to pull sheet edits: %s' % str(e))
+
+    @pulling.before_loop
+    async def before_pulling(self):
+        await self.bot.wait_until_ready()
+
 
 
 def setup(bot):
@@ -1,22 +1,21 @@
 import asyncio
 import json
 import os
-import re
-import time
 
 import discord
 from discord.ext import commands
 from cogs import request
 from ext import auth_config
 from ext import checks
+from ext import deadlines
 from ext import sheet
+from ext import store
 from ext import utils
 
 from dotenv import load_dotenv
 load_dotenv()
 
 LOG_CHANNEL = os.getenv('LOG_CHANNEL')
-TIME_FORMAT = os.getenv('TIME_FORMAT')
 is_staff = checks.is_staff()
 
 
@@ -40,17 +39,21 @@ class Staff(commands.Cog):
     @is_staff
     async def list(self, ctx, req_id=None):
         '''List all applications, or a single one by its ID.'''
-        # Retrieve data_dict from the request log file.
-        data_dict = utils.open_requestlog()
         found = ""
-        for request_id, details in list(data_dict.items()):
-            if not req_id or str(request_id).lower() == str(req_id).lower():
-                # all requests.
-                found += 'application_id: %s\n' % request_id
-                found += utils.printadict(details)
-                found += '\n'
+        if req_id:
+            # A single one may have been archived already.
+            # IDs are generated in upper case.
+            app = store.records.get(str(req_id).upper())
+            apps = [app] if app else []
+        else:
+            # all active requests.
+            apps = store.records.all()
+        for app in apps:
+            found += 'application_id: %s\n' % app.request_id
+            found += utils.printadict(app.to_record())
+            found += '\n'
         if found:
-            time.sleep(1)
+            await asyncio.sleep(1)
             pg_data = utils.paginate(found)
             embed = discord.Embed(title='List Applications')
             embed.color = utils.random_color()
@@ -66,115 +69,101 @@ class Staff(commands.Cog):
     @is_staff
     async def review(self, ctx, req_id, denied=None):
         '''Review an application. The result is either approved or denied.'''
-        data_dict = utils.open_requestlog()
-        user_id = 0
-        staff = None
-        found = False
         found_data = dict()
-        rejected = dict()
-        for request_id, details in list(data_dict.items()):
-            if str(request_id) == str(req_id):
-                found = True
-                staff = ctx.message.author.name
-                staff += '#' + ctx.message.author.discriminator
-                staff_obj = self.bot.get_user(ctx.message.author.id)
-                user_id = details['user_id']
-                if str(denied) == 'denied':
-                    # The message is sent back to a user.
-                    message = ':disappointed_relieved: Thank you for submitting an application for '
-                    message += 'your dream villager! Unfortunately, your application has been '
-                    message += 'rejected after being reviewed by the Beyond Stalks Villager Adoption Team.'
-                    message += '\n\nThe reason for your application\'s rejection is inactivity within '
-                    message += 'the server community. Our adoption program is designed to be a reward '
-                    message += 'for consistently active and positive contributers to the server. '
-                    message += 'Please strive to meet these conditions and we will look forward to '
-                    message += 'a follow-up application from you in due time. You may submit a new '
-                    message += 'application in **2 weeks**.\n'
-                    message += '\nYour application has been closed.\n\n'
-                    message += 'Thanks!\nThe Villager Adoption Team'
-                    # A server message for reference.
-                    server_message = '%s denied an application: %s' % (staff,
-                                                                       req_id)
-                    details['status'] = utils.Status.REJECTED.name
-                    # mark a last_modified timestring
-                    tm = time.localtime(time.time())
-                    timestring = time.strftime(TIME_FORMAT, tm)
-                    details['last_modified'] = timestring
-                    details['staff'] = staff
-                    rejected[request_id] = details
-                    # send to log channel
-                    await self.send_logs(server_message)
-                    # send a DM to note the user.
-                    if user_id:
-                        user = self.bot.get_user(user_id)
-                        dm_chan = user.dm_channel or await user.create_dm()
-                        await dm_chan.send(message)
-                else:
-                    message = 'Application **%s** is now approved by %s!'
-                    await ctx.send(message % (req_id, staff))
-                    details['status'] = utils.Status.APPROVED.name
-                    # mark a last_modified timestring
-                    tm = time.localtime(time.time())
-                    timestring = time.strftime(TIME_FORMAT, tm)
-                    details['last_modified'] = timestring
-                    details['staff'] = staff
-                    # send to log channel
-                    await self.send_logs('%s approved an application: %s' %
-                                         (staff, req_id))
-                    # send a DM to note the user.
-                    if user_id:
-                        user = self.bot.get_user(user_id)
-                        dm_chan = user.dm_channel or await user.create_dm()
-                        user_msg = ('Your application **{}** is approved by a '
-                                    'staff (_{}_).\nPlease use the `~status` '
-                                    'command to check current status.'.format(
-                                        req_id, staff))
-                        await dm_chan.send(user_msg)
-                # Save changes to found_data
-                found_data[request_id] = details
-        if not found:
+        app = store.records.get(req_id)
+        if not app:
             message = 'Cannot find application **%s**' % req_id
             await ctx.send(message)
             # send to log channel
             return await self.send_logs(message)
-        # Write changes back.
-        utils.flush_requestlog(data_dict)
-        time.sleep(1)
-        await sheet.update_data(found_data)
+        staff = ctx.message.author.name
+        staff += '#' + ctx.message.author.discriminator
+        staff_obj = self.bot.get_user(ctx.message.author.id)
+        user_id = app.user_id
+        rejected = str(denied) == 'denied'
+        if rejected:
+            app.status = utils.Status.REJECTED
+        else:
+            app.status = utils.Status.APPROVED
+        # mark a last_modified time
+        app.touch(staff)
+        # Write changes back, unless someone else changed it first.
+        try:
+            await store.records.update(app)
+        except store.ConflictError as e:
+            em = utils.get_embed('red', str(e), title='Application Changed')
+            return await ctx.send(embed=em)
+        found_data[req_id] = app.to_record()
         if rejected:
-            for k, _ in rejected.items():
-                await sheet.archive_column(k)
+            # The message is sent back to a user.
+            message = ':disappointed_relieved: Thank you for submitting an application for '
+            message += 'your dream villager! Unfortunately, your application has been '
+            message += 'rejected after being reviewed by the Beyond Stalks Villager Adoption Team.'
+            message += '\n\nThe reason for your application\'s rejection is inactivity within '
+            message += 'the server community. Our adoption program is designed to be a reward '
+            message += 'for consistently active and positive contributers to the server. '
+            message += 'Please strive to meet these conditions and we will look forward to '
+            message += 'a follow-up application from you in due time. You may submit a new '
+            message += 'application in **2 weeks**.\n'
+            message += '\nYour application has been closed.\n\n'
+            message += 'Thanks!\nThe Villager Adoption Team'
+            # A server message for reference.
+            server_message = '%s denied an application: %s' % (staff,
+                                                               req_id)
+            # send to log channel
+            await self.send_logs(server_message)
+            # send a DM to note the user.
+            if user_id:
+                user = self.bot.get_user(user_id)
+                dm_chan = user.dm_channel or await user.create_dm()
+                await dm_chan.send(message)
+        else:
+            message = 'Application **%s** is now approved by %s!'
+            await ctx.send(message % (req_id, staff))
+            # send to log channel
+            await self.send_logs('%s approved an application: %s' %
+                                 (staff, req_id))
+            # send a DM to note the user.
+            if user_id:
+                user = self.bot.get_user(user_id)
+                dm_chan = user.dm_channel or await user.create_dm()
+                user_msg = ('Your application **{}** is approved by a '
+                            'staff (_{}_).\nPlease use the `~status` '
+                            'command to check current status.'.format(
+                                req_id, staff))
+                await dm_chan.send(user_msg)
+        sheet.queue_update(found_data)
+        if rejected:
+            sheet.queue_archive(req_id)
 
     @commands.command(name='found', aliases=['fnd'])
     @is_staff
     async def found(self, ctx, req_id):
         '''Indicates that you have found a requested villager.'''
-        data_dict = utils.open_requestlog()
         user_id = 0
         staff = ctx.message.author.name
         staff += '#' + ctx.message.author.discriminator
         staff_obj = self.bot.get_user(ctx.message.author.id)
         dreamie = ''
         found_data = dict()
-        for request_id, details in list(data_dict.items()):
-            if str(request_id) == str(req_id):
-                message = 'A villager of this application **%s** was found by %s!'
-                await ctx.send(message % (req_id, staff))
-                details['status'] = utils.Status.FOUND.name
-                dreamie = details['villager']
-                # only get the name
-                dreamie = dreamie.split(',')[0]
-                # mark a last_modified timestring
-                tm = time.localtime(time.time())
-                timestring = time.strftime(TIME_FORMAT, tm)
-                details['last_modified'] = timestring
-                details['staff'] = staff
-                user_id = details['user_id']
-                found_data[request_id] = details
-
-        utils.flush_requestlog(data_dict)
-        time.sleep(1)
-        await sheet.update_data(found_data)
+        app = store.records.get(req_id)
+        if not app:
+            message = 'Cannot find application **%s**' % req_id
+            return await ctx.send(message)
+        app.status = utils.Status.FOUND
+        dreamie = app.villager_name
+        # mark a last_modified time
+        app.touch(staff)
+        user_id = app.user_id
+        try:
+            await store.records.update(app)
+        except store.ConflictError as e:
+            em = utils.get_embed('red', str(e), title='Application Changed')
+            return await ctx.send(embed=em)
+        found_data[req_id] = app.to_record()
+        message = 'A villager of this application **%s** was found by %s!'
+        await ctx.send(message % (req_id, staff))
+        sheet.queue_update(found_data)
         # send to log channel
         await self.send_logs('%s found a requested villager: %s' %
                              (staff, dreamie))
@@ -198,32 +187,32 @@ class Staff(commands.Cog):
     @is_staff
     async def close(self, ctx, req_id):
         '''Close an application and pop some firework.'''
-        data_dict = utils.open_requestlog()
         user_id = 0
         staff = ctx.message.author.name
         staff += '#' + ctx.message.author.discriminator
         staff_obj = self.bot.get_user(ctx.message.author.id)
         villager = None
         found_data = dict()
-        for request_id, details in list(data_dict.items()):
-            if str(request_id) == str(req_id):
-                message = 'Congrats! Application **%s** is now closed by %s!'
-                villager = details['villager'].split(',')[0]
-                await ctx.send(message % (req_id, staff))
-                details['status'] = utils.Status.CLOSED.name
-                # mark a last_modified timestring
-                tm = time.localtime(time.time())
-                timestring = time.strftime(TIME_FORMAT, tm)
-                details['last_modified'] = timestring
-                details['staff'] = staff
-                user_id = details['user_id']
-                found_data[request_id] = details
-
-        utils.flush_requestlog(data_dict)
-        time.sleep(1)
-        await sheet.update_data(found_data)
+        app = store.records.get(req_id)
+        if not app:
+            message = 'Cannot find application **%s**' % req_id
+            return await ctx.send(message)
+        villager = app.villager_name
+        app.status = utils.Status.CLOSED
+        # mark a last_modified time
+        app.touch(staff)
+        user_id = app.user_id
+        try:
+            await store.records.update(app)
+        except store.ConflictError as e:
+            em = utils.get_embed('red', str(e), title='Application Changed')
+            return await ctx.send(embed=em)
+        found_data[req_id] = app.to_record()
+        message = 'Congrats! Application **%s** is now closed by %s!'
+        await ctx.send(message % (req_id, staff))
+        sheet.queue_update(found_data)
         # Then hide the close row.
-        await sheet.archive_column(req_id)
+        sheet.queue_archive(req_id)
 
         # send to log channel
         await self.send_logs('%s closed an application: %s' % (staff, req_id))
@@ -308,31 +297,31 @@ class Staff(commands.Cog):
     @is_staff
     async def claim(self, ctx, req_id):
         '''Claim an application to move its status to PROCESSING.'''
-        data_dict = utils.open_requestlog()
         user_id = 0
         staff = ctx.message.author.name
         staff += '#' + ctx.message.author.discriminator
         staff_obj = self.bot.get_user(ctx.message.author.id)
         found_data = dict()
-        for request_id, details in list(data_dict.items()):
-            if str(request_id) == str(req_id):
-                villager = details['villager'].split(',')[0]
-                details['status'] = utils.Status.PROCESSING.name
-                # mark a last_modified timestring
-                tm = time.localtime(time.time())
-                timestring = time.strftime(TIME_FORMAT, tm)
-                details['last_modified'] = timestring
-                details['staff'] = staff
-                found_data[request_id] = details
-                user_id = details['user_id']
-                name = details['name']
-                break
+        app = store.records.get(req_id)
+        if not app:
+            message = 'Cannot find application **%s**' % req_id
+            return await ctx.send(message)
+        villager = app.villager_name
+        app.status = utils.Status.PROCESSING
+        # mark a last_modified time
+        app.touch(staff)
+        user_id = app.user_id
+        name = app.name
+        try:
+            await store.records.update(app)
+        except store.ConflictError as e:
+            em = utils.get_embed('red', str(e), title='Application Changed')
+            return await ctx.send(embed=em)
+        found_data[req_id] = app.to_record()
         # Send a note back to the staff.
         staff_msg = ('You claimed an application: %s (%s looks for %s).')
         await ctx.send(staff_msg % (req_id, name, villager))
-        utils.flush_requestlog(data_dict)
-        time.sleep(1)
-        await sheet.update_data(found_data)
+        sheet.queue_update(found_data)
         # send to log channel
         await self.send_logs('%s claim an application: %s' % (staff, req_id))
         # send a DM to note the user.
@@ -359,7 +348,6 @@ class Staff(commands.Cog):
     @is_staff
     async def search(self, ctx, *input_args):
         '''Search for a summary, status or name in all applications.'''
-        data_dict = utils.open_requestlog()
         user_id = 0
         # Since this function is shared with a background task.
         # When ctx = None, it will not send the result messages to the user,
@@ -369,13 +357,10 @@ class Staff(commands.Cog):
         tmp_dict = dict()
         target = all_args[0]
         if target == 'summary':
-            total = len(data_dict)
+            total = len(store.records)
             # We don't care about closed, cancel or rejected applications.
             for status in all_status:  # expected_status:
-                tmp_dict[status] = 0
-                for _, details in list(data_dict.items()):
-                    if status == details['status']:
-                        tmp_dict[status] += 1
+                tmp_dict[status] = store.records.count(status)
                 if tmp_dict[status]:
                     ratio = '{} ({:.3f}{})'.format(tmp_dict[status],
                             (tmp_dict[status]/total*100), '%')
@@ -395,33 +380,16 @@ class Staff(commands.Cog):
             # Search by status
             target = target.upper()
             tmp_dict = dict()
-            for request_id, details in list(data_dict.items()):
-                if target == details['status']:
-                    villager = details['villager'].split(', ')[0]
-                    tmp_dict[request_id] = '**{}** looks for _{}_'.format(
-                        details['name'], villager)
-            # Prepare for background reporting task.
-            if not ctx and 'background' in all_args:
-                return tmp_dict
-            if not ctx and 'countdown' in all_args:
-                # For coutndown background tasks, we need to return a raw
-                # details dict.
-                raw_dict = dict()
-                for request_id, details in list(data_dict.items()):
-                    if target == details['status']:
-                        raw_dict[request_id] = details
-                return raw_dict
+            for app in await store.records.read_by_status(target):
+                tmp_dict[app.request_id] = utils.brief(app)
             title = '_%s_ Application' % target.capitalize()
             if len(tmp_dict) > 1:
                 title += 's: *%d*' % len(tmp_dict)
             else:
                 title += ': *%d*' % len(tmp_dict)
             if tmp_dict:
-                embed = discord.Embed(title=title)
-                embed.color = utils.random_color()
-                for k, v in tmp_dict.items():
-                    embed.add_field(name=k, value=v, inline=True)
-                return await ctx.send(embed=embed)
+                return await utils.send_embeds(
+                    ctx, utils.build_embeds(title, tmp_dict.items()))
             else:
                 return await ctx.send('Found nothing for status=%s' % target)
         else:
@@ -436,39 +404,167 @@ class Staff(commands.Cog):
                 # user_id = discord.utils.get(client.get_all_members(), name=name_list[0],
                 #                            discriminator=name_list[1]).id
                 # pattern = re.search(target, details['name'], re.IGNORECASE)
-                for request_id, details in list(data_dict.items()):
-                    if re.search(target, details['name'], re.IGNORECASE):
-                        villager = details['villager'].split(', ')[0]
-                        status = 'Status: {}'.format(details['status'].capitalize())
-                        found[request_id] = '**{}**\n{}'.format(villager, status)
+                for app in await store.records.read_search_name(target):
+                    status = 'Status: {}'.format(app.status.name.capitalize())
+                    found[app.request_id] = '**{}**\n{}'.format(
+                        app.villager_name, status)
                 if found:
-                    embed = discord.Embed(title=title)
-                    embed.color = utils.random_color()
-                    for k, v in found.items():
-                        embed.add_field(name=k, value=v, inline=True)
-                    return await ctx.send(embed=embed)
+                    return await utils.send_embeds(
+                        ctx, utils.build_embeds(title, found.items()))
                 else:
                     return await ctx.send('Found nothing for this name: %s' % target)
     
     @commands.command(name='archive', aliases=['ar'], hidden=True,
                       usage='<req_id> to hide a row of the application id.'
                             'Use anything after <req_id> will toggle and '
-                            'unhide its row')
+                            'unhide its row. Use "all" as <req_id> to hide '
+                            'every closed, cancelled or rejected application, '
+                            'or "rotate [month|quarter]" to move them into '
+                            'archive worksheets.')
     @is_staff
     async def archive(self, ctx, req_id, *input_args):
         '''Archive and hide a row in the sheet by an application ID.'''
-        data_dict = utils.open_requestlog()
         toggle = list(input_args)
+        if req_id.lower() == 'all':
+            # Sweep every finished application in one request. Those that
+            # were rotated out of the sheet already are left alone.
+            finished = store.records.ids_by_status(utils.Status.CLOSED,
+                                                   utils.Status.CANCEL,
+                                                   utils.Status.REJECTED)
+            finished = [request_id for request_id in finished
+                        if await sheet.find_row(request_id)]
+            for request_id in finished:
+                sheet.queue_archive(request_id)
+            await sheet.flush()
+            server_msg = 'DreamieBot archived %d finished applications in the sheet.'
+            return await self.send_logs(server_msg % len(finished))
+        if req_id.lower() == 'rotate':
+            # Move finished rows out of the main worksheet.
+            await sheet.flush()
+            result = await sheet.rotate(toggle[0].lower() if toggle else None)
+            moved = ', '.join('%d to %s' % (v, k) for k, v in result.items())
+            server_msg = 'DreamieBot rotated finished applications: %s.'
+            return await self.send_logs(server_msg % (moved or 'nothing'))
         if not toggle:
             # always hide
-            await sheet.archive_column(req_id)
+            sheet.queue_archive(req_id)
         else:
             # unhide
-            await sheet.archive_column(req_id, False)
+            sheet.queue_archive(req_id, False)
         server_msg = 'DreamieBot archived a row of request_id %s in the sheet.'
         # send to log channel
         return await self.send_logs(server_msg % (req_id))
 
+    async def reconcile_sheet(self):
+        '''Fix the sheet up from the store, shared with the background job.'''
+        apps = store.records.all() + await store.records.read_archived()
+        result = await sheet.reconcile(
+            {app.request_id: app.to_record() for app in apps})
+        fixed = ', '.join('%d %s' % (v, k) for k, v in result.items())
+        await self.send_logs('DreamieBot reconciled the sheet: %s.' % fixed)
+        return result
+
+    async def pull_sheet(self):
+        '''Bring edits staff made in the sheet into the store.
+
+        Status, staff and notes can be edited in the sheet. A status that is
+        not valid is reverted, and so is an edit to an application that
+        changed in the store in the meantime: the store wins. Rows the sheet
+        module sees for the first time are taken only when their Last
+        Modified still matches the store.'''
+        applied = []
+        for req_id, fields in (await sheet.pull()).items():
+            app = store.records.get(req_id)
+            if not app:
+                continue
+            if fields.get('last_modified', None) not in (
+                    None, app.to_record().get('last_modified', '')):
+                # The store moved on since this row was written.
+                sheet.queue_update({req_id: app.to_record()})
+                continue
+            status = fields['status'].strip().upper()
+            if status not in utils.Status.__members__:
+                # Not a status we know, put the right one back.
+                await self.send_logs('Invalid status "%s" for %s in the sheet, '
+                                     'reverted it.' % (fields['status'], req_id))
+                sheet.queue_update({req_id: app.to_record()})
+                continue
+            moved = utils.Status[status] != app.status
+            changed = moved
+            app.status = utils.Status[status]
+            for key in ('staff', 'notes'):
+                value = fields[key].strip() or None
+                if value != (getattr(app, key) or None):
+                    setattr(app, key, value)
+                    changed = True
+            if not changed:
+                continue
+            if moved:
+                # Only a new status starts a new deadline; a note does not.
+                app.touch()
+            try:
+                await store.records.update(app)
+            except store.ConflictError:
+                app = store.records.get(req_id)
+                sheet.queue_update({req_id: app.to_record()})
+                continue
+            if moved:
+                deadlines.timers.schedule(app)
+            # Write back the new last_modified time, and hide finished rows.
+            sheet.queue_update({req_id: app.to_record()})
+            if app.status in store.ARCHIVED_STATUSES:
+                sheet.queue_archive(req_id)
+            applied.append(req_id)
+        if applied:
+            await self.send_logs('DreamieBot took sheet edits of: %s' %
+                                 ', '.join(applied))
+        return applied
+
+    @commands.command(name='note', hidden=True,
+                      usage='<req_id> <notes> to keep notes on an application.')
+    @is_staff
+    async def note(self, ctx, req_id, *notes):
+        '''Keep staff notes on an application, shown in the sheet.'''
+        app = store.records.get(req_id)
+        if not app:
+            message = 'Cannot find application **%s**' % req_id
+            return await ctx.send(message)
+        app.notes = ' '.join(notes) or None
+        try:
+            await store.records.update(app)
+        except store.ConflictError as e:
+            em = utils.get_embed('red', str(e), title='Application Changed')
+            return await ctx.send(embed=em)
+        await sheet.insert_note(req_id, app.notes or '')
+        return await ctx.send('Noted on application **%s**.' % req_id)
+
+    @commands.command(name='reconcile', aliases=['rec'], hidden=True)
+    @is_staff
+    async def reconcile(self, ctx):
+        '''Compare the sheet with every application and fix what differs.'''
+        # Take staff edits first, or the store would write over them.
+        await self.pull_sheet()
+        result = await self.reconcile_sheet()
+        embed = discord.Embed(title='Sheet Reconciled')
+        embed.color = utils.random_color()
+        for k, v in result.items():
+            embed.add_field(name=k.capitalize(), value=v, inline=True)
+        return await ctx.send(embed=embed)
+
+    @commands.command(name='sheet', hidden=True)
+    @is_staff
+    async def sheet_stats(self, ctx):
+        '''Show how the bot is doing against the Google Sheets quota.'''
+        embed = discord.Embed(title='Google Sheets Sync')
+        embed.color = utils.random_color()
+        embed.description = 'Online' if sheet.available else 'Unreachable'
+        for k, v in sheet.stats.items():
+            embed.add_field(name=k.capitalize(), value=v, inline=True)
+        queued = (len(sheet.pending_updates) + len(sheet.pending_archives) +
+                  len(sheet.pending_notes))
+        embed.add_field(name='Queued', value=queued, inline=True)
+        return await ctx.send(embed=embed)
+
 
 def setup(bot):
     bot.add_cog(Staff(bot))
@@ -1,6 +1,5 @@
 import asyncio
 import datetime
-import json
 import os
 import re
 import time
@@ -11,12 +10,14 @@ from dotenv import load_dotenv
 
 from cogs import request
 from ext import checks
+from ext import deadlines
 from ext import sheet
+from ext import store
 from ext import utils
+from ext.application import Application
 
 load_dotenv()
 
-RECORD_FILE = os.getenv('RECORD_FILE')
 LOG_CHANNEL = os.getenv('LOG_CHANNEL')
 TIME_FORMAT = os.getenv('TIME_FORMAT')
 
@@ -58,27 +59,22 @@ class User(commands.Cog):
             return await ctx.channel.send(embed=em)
         # Before starting anything, check if this applicant was rejected in
         # the last two weeks.
-        data_dict = utils.open_requestlog()
         rejected = []
-        for request_id, details in list(data_dict.items()):
-            for k, v in list(details.items()):
-                if k == u'name' and ctx.message.author.name in v:
-                    # also hide requests with status == 'cancel' or 'closed'
-                    if details['status'] in (utils.Status.REJECTED.name):
-                        rejected.append(details)
-        current = datetime.datetime.utcnow()
-        for detail in rejected:
-            # Fixed the period to 2 weeks.
-            then_ts = time.strptime(detail['last_modified'], TIME_FORMAT)
-            then_dt = datetime.datetime.fromtimestamp(time.mktime(then_ts))
-            period = datetime.timedelta(days=14)
-            if (current-then_dt) < period:
+        for app in await store.records.read_by_user(ctx.message.author.id):
+            # only rejected applications count towards the cooldown.
+            if app.status == utils.Status.REJECTED:
+                rejected.append(app)
+        current = time.time()
+        # Fixed the period to 2 weeks.
+        period = datetime.timedelta(days=14).total_seconds()
+        for app in rejected:
+            if (current - app.modified) < period:
                 rejected_msg = ('Sorry, your previous application was closed at '
                                 '%s within a two weeks cooldown.\nPlease come back'
-                                ' and reapply later.' % detail['last_modified'])
+                                ' and reapply later.' % app.last_modified_time)
                 em = utils.get_embed('red', rejected_msg, title='Still In Cooldown')
                 await self.send_logs_user('%s attempted to re-apply a dreamie '
-                                          'while in a 2 weeks cooldown.' % detail['name'])
+                                          'while in a 2 weeks cooldown.' % app.name)
                 return await ctx.channel.send(embed=em)
         # Viallger name differeniation: some villagers have a space char
         # between its names:
@@ -107,10 +103,10 @@ class User(commands.Cog):
             return await ctx.send(result)
         villager_data = "{}, {}".format(villager, villager_link)
 
-        request_id = utils.generate_id(data_dict)  # ctx.message.id
+        request_id = utils.generate_id(store.records)  # ctx.message.id
         name = ctx.message.author.name
         name += '#' + ctx.message.author.discriminator
-        message = checks.precheck(name, villager)
+        message = checks.precheck(ctx.message.author.id, villager)
         if message:
             em = utils.get_embed('red', message, title='Precheck Failed')
             return await ctx.channel.send(embed=em)
@@ -134,7 +130,7 @@ class User(commands.Cog):
         em = utils.get_embed('gray', 'Your Application Details:')
         await ctx.channel.send(embed=em)
         await ctx.channel.send(utils.printadict(details, hide_self=True))
-        time.sleep(1)
+        await asyncio.sleep(1)
         # default null for these two. Added after showing details to users,
         # so they won't know.
         details['last_modified'] = ''
@@ -181,7 +177,7 @@ class User(commands.Cog):
             ":heart: Slot 3: 08:00 - 11:59 UTC.\n:rocket: Slot 4: 12:00 - 15:59 UTC.\n"
             ":crescent_moon: Slot 5: 16:00 - 19:59 UTC.\n:full_moon: Slot 6: "
             "20:00 - 23:59 UTC.\n")
-        time.sleep(1)
+        await asyncio.sleep(1)
         slot_reaction = await flow.get_timeslot_reaction_confirm(timeslot, 600)
         if slot_reaction is None:
             return ctx.send(
@@ -216,18 +212,16 @@ class User(commands.Cog):
             await ctx.send(
                 "%s Please take a note of your application ID:\n**%s**" %
                 (user_obj.mention, request_id))
-            time.sleep(1)
+            await asyncio.sleep(1)
             # Add a default status.
             data += u"Status: {}".format(utils.Status.PENDING.name)
             details['status'] = utils.Status.PENDING.name
 
             # data_dict is keyed by request_id, and its value contains the rest details as a dictionary.
             data_dict[request_id] = details
-            # Open request log file and append to the end.
-            with open(RECORD_FILE, mode="a") as f:
-                json.dump(data_dict, f, indent=None)
-                f.write('\n')
-            await sheet.update_data(data_dict)
+            # Keep it in the store, which appends it to the request log.
+            await store.records.save(Application.from_record(request_id, details))
+            sheet.queue_update(data_dict)
             await self.send_logs_user('%s requested a dreamie (%s) at %s' %
                                       (name, villager.capitalize(), timestring)
                                       )
@@ -235,41 +229,35 @@ class User(commands.Cog):
     @commands.command(name='status', aliases=['st'])
     async def status(self, ctx):
         '''Check the status of a user's application.'''
-        # Retrieve data_dict from the request log file.
-        data_dict = utils.open_requestlog()
         found = ""
-        for request_id, details in list(data_dict.items()):
-            for k, v in list(details.items()):
-                if k == u'name' and ctx.message.author.name in v:
-                    # also hide closed requests with status == 'cancel',
-                    # 'rejected' or 'closed'
-                    if details['status'] not in (utils.Status.CLOSED.name,
-                                                 utils.Status.CANCEL.name,
-                                                 utils.Status.REJECTED.name):
-                        found += 'application_id: **%s**\n' % request_id
-                        found += utils.printadict(details, hide_self=True)
-                        found += '\n'
+        for app in store.records.by_user(ctx.message.author.id):
+            # also hide closed requests with status == 'cancel',
+            # 'rejected' or 'closed'
+            if app.status not in (utils.Status.CLOSED,
+                                  utils.Status.CANCEL,
+                                  utils.Status.REJECTED):
+                found += 'application_id: **%s**\n' % app.request_id
+                found += utils.printadict(app.to_record(), hide_self=True)
+                found += '\n'
         if found:
             await ctx.send("Found your application:")
-            color = utils.status_color(details)
+            color = utils.status_color(app.to_record())
             em = utils.get_embed(color, found)
             await ctx.channel.send(embed=em)
         else:
             em = utils.get_embed('red', "You don\'t have any application.")
             await ctx.channel.send(embed=em)
 
-    def auto_find(self, data_dict, user):
-        '''Automatically find a request id from data dict for this user.'''
+    def auto_find(self, user_id):
+        '''Automatically find a request id from the store for this user.'''
         open_app = []
-        for request_id, details in list(data_dict.items()):
-            for k, v in list(details.items()):
-                if k == u'name' and user in v:
-                    # also hide closed requests with status == 'cancel',
-                    # 'rejected' or 'closed'
-                    if details['status'] not in (utils.Status.CLOSED.name,
-                                                 utils.Status.CANCEL.name,
-                                                 utils.Status.REJECTED.name):
-                        open_app.append(request_id)
+        for app in store.records.by_user(user_id):
+            # also hide closed requests with status == 'cancel',
+            # 'rejected' or 'closed'
+            if app.status not in (utils.Status.CLOSED,
+                                  utils.Status.CANCEL,
+                                  utils.Status.REJECTED):
+                open_app.append(app.request_id)
         if open_app:
             # We only allow one application per user per time. It is safe to assume
             # to return the first element here.
@@ -283,7 +271,6 @@ class User(commands.Cog):
     async def ready(self, ctx, req_id=None):
         '''Send a note to the staff team when you are ready to accept a new villager.'''
         # Check if the requester matches.
-        data_dict = utils.open_requestlog()
         dreamie = None
         found = None
         found_data = dict()
@@ -293,25 +280,16 @@ class User(commands.Cog):
         # Since we only allow 1 application per user per time, do a quick search if
         # req_id = none and there is an open application of this user.
         if not req_id:
-            req_id = self.auto_find(data_dict, ctx.message.author.name)
-        for request_id, details in list(data_dict.items()):
-            if str(request_id) == str(req_id):
-                # user can only mark their own request.
-                for k, v in list(details.items()):
-                    if k == u'name' and ctx.message.author.name in v:
-                        found = (
-                            '%s has marked the application **%s** as ready to '
-                            'accept the dreamie!' %
-                            (ctx.message.author.name, req_id))
-                        details['status'] = utils.Status.READY.name
-                        dreamie = details['villager']
-                        dreamie = dreamie.split(',')[0]
-                        # mark a last_modified timestring
-                        tm = time.localtime(time.time())
-                        timestring = time.strftime(TIME_FORMAT, tm)
-                        details['last_modified'] = timestring
-                        found_data[request_id] = details
-                        break
+            req_id = self.auto_find(ctx.message.author.id)
+        app = store.records.get(req_id)
+        # user can only mark their own request.
+        if app and app.user_id == ctx.message.author.id:
+            found = ('%s has marked the application **%s** as ready to '
+                     'accept the dreamie!' % (ctx.message.author.name, req_id))
+            app.status = utils.Status.READY
+            dreamie = app.villager_name
+            # mark a last_modified time
+            app.touch()
 
         if not found:
             em = utils.get_embed('red',
@@ -330,15 +308,21 @@ class User(commands.Cog):
             em = utils.get_embed('red', 'Aborted.')
             return await ctx.channel.send(embed=em)
         elif reaction:
-            color = utils.status_color(details)
+            try:
+                await store.records.update(app)
+            except store.ConflictError as e:
+                em = utils.get_embed('red', str(e), title='Application Changed')
+                return await ctx.channel.send(embed=em)
+            deadlines.timers.schedule(app)
+            found_data[req_id] = app.to_record()
+            color = utils.status_color(found_data[req_id])
             em = utils.get_embed(color, found)
             await ctx.channel.send(embed=em)
-            utils.flush_requestlog(data_dict)
-            user_obj = self.bot.get_user(found_data[req_id]['user_id'])
+            user_obj = self.bot.get_user(app.user_id)
             await self.send_logs_user('%s is ready to accept a dreamie (%s).' %
-                                      (found_data[req_id]['name'], dreamie))
-            await sheet.update_data(found_data)
-            staff_lst = found_data[req_id]['staff'].split('#')
+                                      (app.name, dreamie))
+            sheet.queue_update(found_data)
+            staff_lst = app.staff.split('#')
             staff_id = discord.utils.get(self.bot.get_all_members(), name=staff_lst[0],
                                           discriminator=staff_lst[1]).id
             staff_obj = self.bot.get_user(staff_id)
@@ -386,7 +370,6 @@ class User(commands.Cog):
     async def cancel(self, ctx, req_id=None):
         '''Cancel an application.'''
         # Check if the requester matches, or a staff can cancel.
-        data_dict = utils.open_requestlog()
 
         # Setup a Flow controller.
         flow = request.Flow(self.bot, ctx)
@@ -395,25 +378,17 @@ class User(commands.Cog):
         # Since we only allow 1 application per user per time, do a quick search if
         # req_id = none and there is an open application of this user.
         if not req_id:
-            req_id = self.auto_find(data_dict, ctx.message.author.name)
-        for request_id, details in list(data_dict.items()):
-            if str(request_id) == str(req_id):
-                # user can only cancel their own request.
-                for k, v in list(details.items()):
-                    if k == u'name' and ctx.message.author.name in v:
-                        message = 'You are about to cancel an application **%s**' % req_id
-                        em = utils.get_embed('red',
-                                             message,
-                                             title='Cancel An Application')
-                        await ctx.channel.send(embed=em)
-                        found = True
-                        details['status'] = utils.Status.CANCEL.name
-                        # mark a last_modified timestring
-                        tm = time.localtime(time.time())
-                        timestring = time.strftime(TIME_FORMAT, tm)
-                        details['last_modified'] = timestring
-                        found_data[request_id] = details
-                        break
+            req_id = self.auto_find(ctx.message.author.id)
+        app = store.records.get(req_id)
+        # user can only cancel their own request.
+        if app and app.user_id == ctx.message.author.id:
+            message = 'You are about to cancel an application **%s**' % req_id
+            em = utils.get_embed('red', message, title='Cancel An Application')
+            await ctx.channel.send(embed=em)
+            found = True
+            app.status = utils.Status.CANCEL
+            # mark a last_modified time
+            app.touch()
         if not found:
             message = 'Your application %s was not found.' % req_id
             em = utils.get_embed('red', message, title='Application Not Found')
@@ -422,7 +397,7 @@ class User(commands.Cog):
 
         are_you_sure = await ctx.send(
             f":information_source: Please confirm YES/NO to cancel"
-            f" this application **%s**" % request_id)
+            f" this application **%s**" % req_id)
 
         reaction = await flow.get_yes_no_reaction_confirm(are_you_sure, 200)
         if reaction is None:
@@ -431,13 +406,18 @@ class User(commands.Cog):
             em = utils.get_embed('red', 'Aborted.')
             return await ctx.channel.send(embed=em)
         elif reaction:
-            utils.flush_requestlog(data_dict)
+            try:
+                await store.records.update(app)
+            except store.ConflictError as e:
+                em = utils.get_embed('red', str(e), title='Application Changed')
+                return await ctx.channel.send(embed=em)
+            found_data[req_id] = app.to_record()
             await ctx.send(f"You\'ve cancelled this application.")
             await self.send_logs_user('Cancelled application %s by %s' %
                                       (req_id, ctx.message.author.name))
-            await sheet.update_data(found_data)
+            sheet.queue_update(found_data)
             # Then hide the close row.
-            await sheet.archive_column(req_id)
+            sheet.queue_archive(req_id)
 
 
 def setup(bot):
@@ -0,0 +1,169 @@
+'''The typed application record kept by the store.'''
+import os
+import sys
+import time
+
+from dotenv import load_dotenv
+
+from ext import utils
+
+load_dotenv()
+TIME_FORMAT = os.getenv('TIME_FORMAT')
+
+
+def now():
+    '''Current time as epoch seconds, the unit Application timestamps use.'''
+    return int(time.time())
+
+
+def parse_time(text):
+    '''Parse a TIME_FORMAT string into epoch seconds.
+
+    Strings that do not parse are returned as they are, so nothing read from
+    disk is lost.'''
+    try:
+        return int(time.mktime(time.strptime(text, TIME_FORMAT)))
+    except (TypeError, ValueError):
+        return text
+
+
+def load_time(value):
+    '''Read a timestamp field: None if absent, 0 if empty, else parsed.'''
+    if value is None:
+        return None
+    return parse_time(value) if value else 0
+
+
+def format_time(value):
+    '''Format epoch seconds back into a TIME_FORMAT string.'''
+    if isinstance(value, int):
+        return time.strftime(TIME_FORMAT, time.localtime(value)) if value else ''
+    return value
+
+
+def intern(value):
+    '''Share one copy of strings that repeat across many applications.'''
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class Application:
+    '''A villager application.
+
+    Status is a utils.Status member, timestamps are epoch seconds and the
+    villager is split into its name and link, so nothing has to be parsed
+    again after loading. For the optional fields, None means the record on
+    disk did not have that key; a timestamp of 0 means the key was there but
+    empty. Keys the bot does not know about are kept in extra.'''
+    __slots__ = ('request_id', 'name', 'user_id', 'villager_name',
+                 'villager_link', 'created', 'last_modified',
+                 'can_time_travel', 'avail_time', 'status', 'staff',
+                 'notes', 'version', 'extra')
+
+    def __init__(self, request_id, name, user_id, villager_name,
+                 villager_link='', created=None, last_modified=None,
+                 can_time_travel=None, avail_time=None,
+                 status=utils.Status.PENDING, staff=None, notes=None,
+                 version=0, extra=None):
+        self.request_id = str(request_id)
+        self.name = intern(name)
+        self.user_id = user_id
+        self.villager_name = intern(villager_name)
+        self.villager_link = intern(villager_link)
+        self.created = created
+        self.last_modified = last_modified
+        self.can_time_travel = can_time_travel
+        self.avail_time = intern(avail_time)
+        self.status = status
+        self.staff = intern(staff)
+        # Staff notes, kept in the Notes column of the sheet.
+        self.notes = notes
+        self.version = version
+        self.extra = extra
+
+    @classmethod
+    def from_record(cls, request_id, record):
+        '''Build an Application from a record.txt style details dict.'''
+        record = dict(record)
+        villager = record.pop('villager', '')
+        villager_name, _, villager_link = villager.partition(',')
+        return cls(request_id,
+                   record.pop('name', ''),
+                   record.pop('user_id', 0),
+                   villager_name.strip(),
+                   villager_link.strip(),
+                   created=load_time(record.pop('created_time', None)),
+                   last_modified=load_time(record.pop('last_modified', None)),
+                   can_time_travel=record.pop('can_time_travel', None),
+                   avail_time=record.pop('avail_time', None),
+                   status=utils.Status[record.pop('status',
+                                                  utils.Status.PENDING.name)],
+                   staff=record.pop('staff', None),
+                   notes=record.pop('notes', None),
+                   version=record.pop('version', 0),
+                   extra=record or None)
+
+    def to_record(self):
+        '''Convert back to the details dict written to disk.'''
+        record = {
+            'name': self.name,
+            'user_id': self.user_id,
+            'villager': self.villager,
+        }
+        for key, value in (('created_time', self.created),
+                           ('last_modified', self.last_modified)):
+            if value is not None:
+                record[key] = format_time(value)
+        for key, value in (('staff', self.staff),
+                           ('can_time_travel', self.can_time_travel),
+                           ('avail_time', self.avail_time),
+                           ('notes', self.notes)):
+            if value is not None:
+                record[key] = value
+        record['status'] = self.status.name
+        if self.version:
+            record['version'] = self.version
+        if self.extra:
+            record.update(self.extra)
+        return record
+
+    def copy(self):
+        '''A copy that can be edited without touching the stored one.'''
+        return Application(self.request_id, self.name, self.user_id,
+                           self.villager_name, self.villager_link,
+                           self.created, self.last_modified,
+                           self.can_time_travel, self.avail_time, self.status,
+                           self.staff, self.notes, self.version,
+                           dict(self.extra) if self.extra else None)
+
+    @property
+    def villager(self):
+        '''The villager as "Name, URL", as it is stored on disk.'''
+        if self.villager_link:
+            return '%s, %s' % (self.villager_name, self.villager_link)
+        return self.villager_name
+
+    @property
+    def created_time(self):
+        return format_time(self.created) or ''
+
+    @property
+    def last_modified_time(self):
+        return format_time(self.last_modified) or ''
+
+    @property
+    def modified(self):
+        '''Epoch seconds of the last change, falling back to creation time.'''
+        for value in (self.last_modified, self.created):
+            if isinstance(value, int) and value:
+                return value
+        return 0
+
+    def touch(self, staff=None):
+        '''Mark the application modified now, optionally by a staff.'''
+        self.last_modified = now()
+        if staff is not None:
+            self.staff = intern(staff)
+
+    def __repr__(self):
+        return '<Application %s %s %s>' % (self.request_id, self.name,
+                                           self.status.name)
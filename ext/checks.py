@@ -6,8 +6,9 @@ import re
 from discord.ext import commands
 from dotenv import load_dotenv
 
-from ext import utils
 from ext import auth_config
+from ext import store
+from ext import utils
 
 load_dotenv()
 
@@ -16,24 +17,21 @@ REQUEST_LIMIT = int(os.getenv('REQUEST_LIMIT'))
 VILLAGER_NAMES = os.getenv('VILLAGER_NAMES')
 
 
-def precheck(user, villager):
+def precheck(user_id, villager):
         '''Precheck steps before processing requests.'''
-        data_dict = utils.open_requestlog()
         # Precheck will fail when either one of these conditions is met:
         # - The user requested this villager before, so this is a duplicated check.
         # - The user has too many requests. See the default in REQUEST_LIMIT=1.
         message = ''
         villagers = []
         last_rejected = []
-        for request_id, details in list(data_dict.items()):
-            if details['name'] == str(user) and (details['villager'] == villager):
+        for app in store.records.by_user(user_id):
+            if app.villager == villager:
                 message = 'You have requested a duplicated villager, check your application with ~status.'
                 return message
-            for k, v in list(details.items()):
-                if (str(k) == 'name' and user in v and (details['status'] not in (
-                        utils.Status.CLOSED.name, utils.Status.CANCEL.name, utils.Status.REJECTED.name))):
-                    villagers.append(str(details['villager']))
-                # if (str(k) == 'name' and user in v and (details['status']
+            if app.status not in (
+                    utils.Status.CLOSED, utils.Status.CANCEL, utils.Status.REJECTED):
+                villagers.append(app.villager)
         # Use re.match to search pattern here.
         pattern = re.compile(str(villager).lower())
         for v in villagers:
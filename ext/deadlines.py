@@ -0,0 +1,101 @@
+'''Deadlines of ready applications: the reminders and the automatic close.'''
+import asyncio
+import heapq
+import os
+import time
+
+from dotenv import load_dotenv
+
+from ext import store
+from ext import utils
+
+load_dotenv()
+
+# When an application is ready, we allow 72 hours until it is finished.
+COUNTDOWN_HOURS = int(os.getenv('COUNTDOWN_HOURS') or 72)
+# Minutes before the deadline the applicant is reminded at.
+REMINDER_MINUTES = (360, 180, 60)
+# The action of the deadline itself: close the application.
+EXPIRE = 0
+
+
+class Deadlines:
+    '''A min-heap of (due_time, request_id, action, modified) entries.
+
+    action is the reminder tier in minutes, or EXPIRE. Entries are not
+    removed when an application moves on. Each one carries the modified time
+    its deadline was computed from, and is dropped when it comes up if the
+    application is no longer READY or changed since. An application that is
+    still READY but was changed is scheduled again from its new time.'''
+    def __init__(self):
+        self.heap = []
+        # request_id -> modified time of its entries in the heap.
+        self.scheduled = dict()
+        self.wakeup = asyncio.Event()
+
+    def _push(self, app):
+        deadline = app.modified + COUNTDOWN_HOURS * 3600
+        for minutes in REMINDER_MINUTES + (EXPIRE,):
+            heapq.heappush(self.heap, (deadline - minutes * 60,
+                                       app.request_id, minutes, app.modified))
+        self.scheduled[app.request_id] = app.modified
+
+    def schedule(self, app):
+        '''Add the reminders and deadline of an application that is READY.'''
+        if app.status != utils.Status.READY:
+            return
+        if self.scheduled.get(app.request_id) == app.modified:
+            return
+        self._push(app)
+        # The sleeper may be waiting for something later than this.
+        self.wakeup.set()
+
+    def rebuild(self):
+        '''Fill the heap from the store, i.e. on start up.'''
+        self.heap = []
+        self.scheduled = dict()
+        for app in store.records.by_status(utils.Status.READY):
+            self._push(app)
+        self.wakeup.set()
+        return len(self.scheduled)
+
+    async def wait(self):
+        '''Sleep until the next entry is due or something new is scheduled.'''
+        self.wakeup.clear()
+        timeout = None
+        if self.heap:
+            timeout = self.heap[0][0] - time.time()
+            if timeout <= 0:
+                return
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def due(self, now=None):
+        '''Pop everything due by now, as [(action, app)].
+
+        Only the most urgent action of each application is returned, so an
+        application that is already past two reminder tiers (i.e. after a
+        restart) is reminded once, and one past its deadline is only closed.'''
+        now = now or time.time()
+        found = dict()
+        while self.heap and self.heap[0][0] <= now:
+            _, request_id, action, modified = heapq.heappop(self.heap)
+            app = store.records.get(request_id)
+            if app is None or app.status != utils.Status.READY:
+                if self.scheduled.get(request_id) == modified:
+                    del self.scheduled[request_id]
+                continue
+            if app.modified != modified:
+                # Changed since; its new entries may be due already.
+                self.schedule(app)
+                continue
+            if action == EXPIRE:
+                del self.scheduled[request_id]
+            if request_id not in found or action < found[request_id][0]:
+                found[request_id] = (action, app)
+        return list(found.values())
+
+
+timers = Deadlines()
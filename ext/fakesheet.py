@@ -0,0 +1,312 @@
+'''An in-memory stand-in for the parts of gspread the bot uses.
+
+Set SHEET_BACKEND=fake to run the bot without Google credentials. Every call
+is recorded in FakeClient.calls, so the number of Sheets API requests a
+command costs can be measured offline:
+
+    python -m ext.fakesheet
+'''
+import asyncio
+import collections
+import os
+import re
+import time
+
+import gspread
+
+# Simulated round trip of one Sheets API request, in seconds.
+LATENCY = {'read': 0.25, 'write': 0.35}
+# Google's default quotas: requests per minute per user, reads and writes.
+QUOTA = {'read': 60, 'write': 60}
+READS = ('open_by_key', 'worksheet', 'worksheets', 'col_values', 'find',
+         'get_all_records', 'values_get', 'fetch_sheet_metadata')
+
+Cell = collections.namedtuple('Cell', 'row col value')
+Call = collections.namedtuple('Call', 'name kind latency')
+
+
+def parse_a1(a1):
+    '''Split "'Sheet1'!A5:J5" into (title, first row, first col, last row, last col).
+
+    Missing parts are None; columns are 1-based numbers.'''
+    match = re.match(r"^(?:'?(.*?)'?!)?([A-Z]+)(\d+)?(?::([A-Z]+)(\d+)?)?$", a1)
+    if not match:
+        raise ValueError('Unsupported range: %s' % a1)
+    title, col1, row1, col2, row2 = match.groups()
+
+    def number(col):
+        n = 0
+        for c in col:
+            n = n * 26 + ord(c) - ord('A') + 1
+        return n
+    return (title, int(row1) if row1 else None, number(col1),
+            int(row2) if row2 else None, number(col2) if col2 else None)
+
+
+class FakeClient:
+    '''Stands in for gspread.Client, and owns the record of every call.'''
+    def __init__(self):
+        self.calls = []
+        self.spreadsheets = dict()
+
+    def record(self, name):
+        kind = 'read' if name in READS else 'write'
+        self.calls.append(Call(name, kind, LATENCY[kind]))
+
+    def open_by_key(self, key):
+        self.record('open_by_key')
+        if key not in self.spreadsheets:
+            self.spreadsheets[key] = FakeSpreadsheet(self)
+        return self.spreadsheets[key]
+
+    def summary(self, since=0):
+        '''Count calls, reads, writes and simulated latency after index since.'''
+        calls = self.calls[since:]
+        reads = sum(1 for c in calls if c.kind == 'read')
+        return {
+            'calls': len(calls),
+            'reads': reads,
+            'writes': len(calls) - reads,
+            'latency': sum(c.latency for c in calls),
+            # Share of one minute's quota, the larger of the two.
+            'quota': max(reads / QUOTA['read'],
+                         (len(calls) - reads) / QUOTA['write']),
+            'names': collections.Counter(c.name for c in calls),
+        }
+
+
+class FakeSpreadsheet:
+    def __init__(self, client):
+        self.client = client
+        self.sheets = collections.OrderedDict()
+        self.add('Sheet1')
+
+    def add(self, title):
+        wks = FakeWorksheet(self, len(self.sheets), title)
+        self.sheets[title] = wks
+        return wks
+
+    def by_id(self, sheet_id):
+        for wks in self.sheets.values():
+            if wks.id == sheet_id:
+                return wks
+        raise KeyError(sheet_id)
+
+    def worksheet(self, title):
+        self.client.record('worksheet')
+        return self.sheets[title]
+
+    def worksheets(self):
+        self.client.record('worksheets')
+        return list(self.sheets.values())
+
+    def values_get(self, a1, params=None):
+        self.client.record('values_get')
+        title, _, _, _, _ = parse_a1(a1)
+        rows = self.sheets[title or 'Sheet1'].rows
+        return {'values': [[str(v) for v in row] for row in rows]}
+
+    def values_batch_update(self, body):
+        self.client.record('values_batch_update')
+        for data in body['data']:
+            title, row, col, _, _ = parse_a1(data['range'])
+            wks = self.sheets[title or 'Sheet1']
+            for i, values in enumerate(data['values']):
+                wks.write(row + i, col, values)
+
+    def values_append(self, a1, params, body):
+        self.client.record('values_append')
+        title, _, _, _, _ = parse_a1(a1)
+        self.sheets[title or 'Sheet1'].rows.extend(
+            list(values) for values in body['values'])
+
+    def fetch_sheet_metadata(self, params=None):
+        self.client.record('fetch_sheet_metadata')
+        params = params or dict()
+        if params.get('includeGridData'):
+            title, _, _, _, _ = parse_a1(params['ranges'])
+            wks = self.sheets[title or 'Sheet1']
+            row_data = [{'values': [{'formattedValue': str(v)} for v in row]}
+                        for row in wks.rows]
+            row_metadata = [{'hiddenByUser': i in wks.hidden}
+                            for i in range(len(wks.rows))]
+            return {'sheets': [{'data': [{'rowData': row_data,
+                                          'rowMetadata': row_metadata}]}]}
+        return {'sheets': [{'properties': {'sheetId': wks.id,
+                                           'title': wks.title},
+                            'conditionalFormats': list(wks.rules)}
+                           for wks in self.sheets.values()]}
+
+    def batch_update(self, body):
+        self.client.record('batch_update')
+        for request in body['requests']:
+            name, args = list(request.items())[0]
+            if name == 'addSheet':
+                self.add(args['properties']['title'])
+            elif name == 'updateDimensionProperties':
+                cells = args['range']
+                wks = self.by_id(cells['sheetId'])
+                for i in range(cells['startIndex'], cells['endIndex']):
+                    if args['properties']['hiddenByUser']:
+                        wks.hidden.add(i)
+                    else:
+                        wks.hidden.discard(i)
+            elif name == 'deleteDimension':
+                cells = args['range']
+                wks = self.by_id(cells['sheetId'])
+                del wks.rows[cells['startIndex']:cells['endIndex']]
+                count = cells['endIndex'] - cells['startIndex']
+                wks.hidden = {i if i < cells['startIndex'] else i - count
+                              for i in wks.hidden
+                              if not cells['startIndex'] <= i < cells['endIndex']}
+            elif name == 'addConditionalFormatRule':
+                wks = self.by_id(args['rule']['ranges'][0]['sheetId'])
+                wks.rules.insert(args['index'], args['rule'])
+            elif name == 'deleteConditionalFormatRule':
+                self.by_id(args['sheetId']).rules.pop(args['index'])
+            # repeatCell and other formats change nothing we keep.
+        return {'replies': [{} for _ in body['requests']]}
+
+
+class FakeWorksheet:
+    def __init__(self, spreadsheet, sheet_id, title):
+        self.spreadsheet = spreadsheet
+        self.id = sheet_id
+        self.title = title
+        self.rows = []
+        # 0-based indexes of hidden rows.
+        self.hidden = set()
+        self.rules = []
+
+    def record(self, name):
+        self.spreadsheet.client.record(name)
+
+    def write(self, row, col, values):
+        while len(self.rows) < row:
+            self.rows.append([])
+        cells = self.rows[row - 1]
+        while len(cells) < col - 1 + len(values):
+            cells.append('')
+        cells[col - 1:col - 1 + len(values)] = list(values)
+
+    def col_values(self, col):
+        self.record('col_values')
+        values = [row[col - 1] if len(row) >= col else '' for row in self.rows]
+        while values and values[-1] == '':
+            values.pop()
+        return values
+
+    def find(self, query):
+        self.record('find')
+        for r, row in enumerate(self.rows, start=1):
+            for c, value in enumerate(row, start=1):
+                if str(value) == str(query):
+                    return Cell(r, c, value)
+        raise gspread.exceptions.CellNotFound(query)
+
+    def update_cell(self, row, col, value):
+        self.record('update_cell')
+        self.write(row, col, [value])
+
+    def format(self, a1, cell_format):
+        self.record('format')
+
+    def append_rows(self, values, value_input_option='RAW'):
+        self.record('append_rows')
+        first = len(self.rows) + 1
+        self.rows.extend(list(row) for row in values)
+        return {'updates': {'updatedRange': "'%s'!A%d:J%d" % (
+            self.title, first, len(self.rows))}}
+
+    def append_row(self, values, value_input_option='RAW'):
+        return self.append_rows([values], value_input_option)
+
+    def get_all_records(self):
+        self.record('get_all_records')
+        if not self.rows:
+            return []
+        headers = self.rows[0]
+        return [dict(zip(headers, row)) for row in self.rows[1:]]
+
+
+def service_account():
+    '''Stands in for gspread.service_account().'''
+    return FakeClient()
+
+
+def application(request_id, status, minute=0):
+    '''Details of one application, as the store hands them to the sheet.'''
+    tm = time.strftime(os.getenv('TIME_FORMAT') or '%Y-%m-%d %H:%M:%S',
+                       time.localtime(1590000000 + minute * 60))
+    return {request_id: {
+        'name': 'applicant%s#0001' % request_id,
+        'user_id': 1,
+        'villager': 'Raymond, https://villagerdb.com/villager/raymond',
+        'created_time': tm,
+        'last_modified': tm,
+        'can_time_travel': False,
+        'avail_time': 'any time',
+        'staff': 'staff#0001',
+        'status': status,
+    }}
+
+
+async def benchmark():
+    '''Drive the sheet through every command's path and count its calls.'''
+    from ext import sheet
+
+    client = FakeClient()
+    sheet.gc = client
+    flows = []
+
+    async def measure(name, step):
+        since = len(client.calls)
+        await step()
+        await sheet.flush()
+        flows.append((name, client.summary(since)))
+
+    async def change(status, archive=False, request_id='A1'):
+        sheet.queue_update(application(request_id, status))
+        if archive:
+            sheet.queue_archive(request_id)
+
+    async def burst():
+        # claim, found and ready before the next flush; written once.
+        for status in ('PROCESSING', 'FOUND', 'READY'):
+            sheet.queue_update(application('B2', status))
+
+    async def many():
+        for i in range(50):
+            sheet.queue_update(application('C%02d' % i, 'CLOSED', i))
+            sheet.queue_archive('C%02d' % i)
+
+    await measure('warm up', sheet.warm_up)
+    await measure('apply', lambda: change('PENDING'))
+    await measure('review', lambda: change('APPROVED'))
+    await measure('claim', lambda: change('PROCESSING'))
+    await measure('found', lambda: change('FOUND'))
+    await measure('ready', lambda: change('READY'))
+    await measure('close', lambda: change('CLOSED', archive=True))
+    await measure('apply B2',
+                  lambda: change('PENDING', request_id='B2'))
+    await measure('burst x3', burst)
+    await measure('close 50', many)
+    await measure('pull', sheet.pull)
+    await measure('reconcile', lambda: sheet.reconcile(
+        {k: v for i in range(50)
+         for k, v in application('C%02d' % i, 'CLOSED', i).items()}))
+    await measure('rotate', sheet.rotate)
+    await sheet.close()
+
+    print('%-10s %6s %6s %6s %9s %7s  %s' % ('flow', 'calls', 'reads',
+                                           'writes', 'latency', 'quota',
+                                           'requests'))
+    for name, result in flows:
+        names = ', '.join('%s x%d' % item for item in result['names'].items())
+        print('%-10s %6d %6d %6d %8.2fs %6.1f%%  %s' % (
+            name, result['calls'], result['reads'], result['writes'],
+            result['latency'], result['quota'] * 100, names))
+
+
+if __name__ == '__main__':
+    asyncio.run(benchmark())
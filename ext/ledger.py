@@ -0,0 +1,84 @@
+'''A small on-disk ledger of the notifications already sent.
+
+It keeps the bot from sending the same reminder or status report twice,
+including across restarts and ~reload.'''
+import asyncio
+import json
+import logging
+import os
+import time
+
+from dotenv import load_dotenv
+
+from ext import store
+
+load_dotenv()
+LEDGER_FILE = os.getenv('LEDGER_FILE') or '%s.ledger' % store.RECORD_FILE
+# Most entries kept; beyond that the ones expiring first are dropped.
+LEDGER_SIZE = int(os.getenv('LEDGER_SIZE') or 1000)
+
+logger = logging.getLogger('bot')
+
+
+class Ledger:
+    '''key -> (value, expires) of what was sent.
+
+    A key is sent already when the ledger holds the same value for it, so a
+    reminder keyed by application and tier is sent again only when the
+    application's deadline moved. Entries are dropped once expired (epoch
+    seconds; None never expires), and the whole ledger is written on every
+    change, so it stays small.'''
+    def __init__(self, path, size=LEDGER_SIZE):
+        self.path = path
+        self.size = size
+        self.entries = dict()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                self.entries = {k: tuple(v) for k, v in json.load(f).items()}
+        except FileNotFoundError:
+            self.entries = dict()
+        except ValueError as e:
+            # Worst case a few notifications go out twice.
+            logger.error('Ignoring a broken ledger %s: %s', self.path, str(e))
+            self.entries = dict()
+        self.evict()
+        return self
+
+    async def save(self):
+        '''Write the ledger on the store's writer thread, off the event loop.'''
+        lines = [json.dumps(self.entries)]
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(store.records.executor, store.write_atomic,
+                                   self.path, lines)
+
+    def evict(self, now=None):
+        '''Drop expired entries, then the soonest to expire beyond size.'''
+        now = now or time.time()
+        self.entries = {k: v for k, v in self.entries.items()
+                        if v[1] is None or v[1] > now}
+        if len(self.entries) > self.size:
+            keys = sorted(self.entries, key=lambda k: (
+                self.entries[k][1] is None, self.entries[k][1] or 0))
+            for key in keys[:len(self.entries) - self.size]:
+                del self.entries[key]
+
+    def get(self, key):
+        '''The value last sent for key, or None.'''
+        entry = self.entries.get(key)
+        if entry is None or (entry[1] is not None and entry[1] <= time.time()):
+            return None
+        return entry[0]
+
+    def seen(self, key, value=True):
+        return self.get(key) == value
+
+    async def mark(self, key, value=True, expires=None):
+        '''Record that value was sent for key, and write the ledger.'''
+        self.entries[key] = (value, expires)
+        self.evict()
+        await self.save()
+
+
+sent = Ledger(LEDGER_FILE).load()
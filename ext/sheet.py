@@ -1,188 +1,816 @@
 '''Modify applicant data in a Google Sheet by the bot.'''
+from concurrent.futures import ThreadPoolExecutor
 import asyncio
+import functools
+import hashlib
+import logging
+import os
+import random
+import re
+import time
 
 import gspread
+from dotenv import load_dotenv
 from gspread_formatting import *
 
+from ext import fakesheet
 from ext import utils
 
+load_dotenv()
+
 # Sheet ID in the url, just behind https://docs.google.com/spreadsheets/d/<ID is here>
 GSHEET_ID = '1rrwexbsVgOoKslDllp7-Sc0TPwoJxP9W_yKesg02tpo'
 # Or if the spreadhseet has been shared with you, you can search by its title.
 # GSHEET_TITLE='Test discordbot-updater sheets'
 # Which worksheet will the bot modify
 GSHEET_WORKSHEET = 'Sheet1'
+# Finished applications are rotated into one worksheet per 'month' or
+# 'quarter', named i.e. "Archive 2020-06" or "Archive 2020-Q2".
+SHEET_ARCHIVE_PERIOD = os.getenv('SHEET_ARCHIVE_PERIOD') or 'month'
+TIME_FORMAT = os.getenv('TIME_FORMAT')
+# 'fake' keeps the sheet in memory (see ext/fakesheet.py), i.e. to run the
+# bot without Google credentials.
+SHEET_BACKEND = os.getenv('SHEET_BACKEND') or 'google'
+
+# Opened by connect() on first use, so importing this module never waits on
+# Google and the bot still starts while Sheets is down.
+gc = None
+sheet = None
+wks = None
+# False while Sheets cannot be reached; changes stay queued until it is back.
+available = True
+
+logger = logging.getLogger('bot')
+
+# request_id -> row number in wks, read once by load_rows() and kept up to
+# date as rows are appended, so rows are addressed without wks.find.
+# Sorting or deleting rows by hand in the sheet invalidates it; run
+# load_rows() again after that.
+row_index = None
+# The last used row, headers included.
+last_row = 0
+# request_id -> row_hash() of the row as last written or read, so pull()
+# can tell which rows staff edited in the sheet since.
+row_hashes = dict()
+
+# Seconds between two pushes of queued changes to the sheet.
+SYNC_SECONDS = float(os.getenv('SHEET_SYNC_SECONDS') or 5)
+# Changes waiting for the sync task. Both are keyed by request_id, so a burst
+# of changes to one application is written once, with its latest state.
+pending_updates = dict()
+pending_archives = dict()
+pending_notes = dict()
+sync_task = None
+sync_lock = asyncio.Lock()
+
+# gspread blocks on HTTP, so its calls run on a few threads of their own.
+SHEET_WORKERS = int(os.getenv('SHEET_WORKERS') or 2)
+# Give up waiting on a single Sheets call after this many seconds.
+SHEET_TIMEOUT = float(os.getenv('SHEET_TIMEOUT') or 30)
+executor = ThreadPoolExecutor(max_workers=SHEET_WORKERS,
+                              thread_name_prefix='sheet')
+# Google allows 60 requests per minute per user; stay inside that.
+SHEET_QUOTA = int(os.getenv('SHEET_QUOTA') or 60)
+# How many times a rate limited or briefly failing call is tried again.
+SHEET_RETRIES = int(os.getenv('SHEET_RETRIES') or 5)
+# HTTP statuses worth another try: rate limited, or Sheets having a hiccup.
+RETRY_STATUSES = (429, 500, 503)
+# Counters for ~sheet: calls sent, calls held back by the bucket, and
+# calls that failed and were tried again.
+stats = {'calls': 0, 'throttled': 0, 'retried': 0}
+
+
+class TokenBucket:
+    '''Spread calls out so they stay within a per-minute quota.
+
+    Holds up to per_minute tokens and refills them evenly over the minute.
+    Low priority calls leave a fifth of the bucket to the others, so
+    cosmetic formatting never uses up the quota user-visible writes need.'''
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60
+        self.reserve = per_minute // 5
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def take(self, low_priority=False):
+        '''Wait for a token. Returns True if the call had to wait.'''
+        floor = self.reserve if low_priority else 0
+        waited = False
+        while True:
+            self._refill()
+            if self.tokens - 1 >= floor:
+                self.tokens -= 1
+                return waited
+            waited = True
+            await asyncio.sleep((floor + 1 - self.tokens) / self.rate)
+
+    def drain(self):
+        '''Empty the bucket, i.e. after Google said we went over the quota.'''
+        self._refill()
+        self.tokens = min(self.tokens, 0)
+
+
+bucket = TokenBucket(SHEET_QUOTA)
+
 
-gc = gspread.service_account()
-
-# Open a sheet from a spreadsheet in one go
-sheet = gc.open_by_key(GSHEET_ID)
-wks = sheet.worksheet(GSHEET_WORKSHEET)
-
-
-def format_color(status, time_travel=False):
-    '''Format different colors by status.'''
-    cell_color = None
-    # Setup dictionaries of cell formats.
-    text_format = dict()
-    tmp = dict()
-    tmp['fontFamily'] = 'Arial'
-    tmp['fontSize'] = 10
-    text_format['textFormat'] = tmp
-
-    red_text_format = text_format.copy()
-    tmp_red = red_text_format['textFormat']
-    tmp_red['foregroundColor'] = {'red': 1}
-
-    # Status = PENDING, it is also the base of other colors.
-    cell_white = dict()
-    cell_white['horizontalAlignment'] = 'center'
-    cell_white['verticalAlignment'] = 'bottom'
-    cell_white['wrapStrategy'] = 'OVERFLOW_CELL'
-    cell_white['hyperlinkDisplayType'] = 'PLAIN_TEXT'
-    cell_white['backgroundColor'] = {'red': 1, 'green': 1, 'blue': 1}
-
-    # Status = PROCESSING
-    cell_yellow = cell_white.copy()
-    cell_yellow['backgroundColor'] = {'red': 1, 'green': 1}
-
-    # Status = FOUND
-    cell_orange = cell_white.copy()
-    cell_orange['backgroundColor'] = {'red': 1, 'green': 0.6}
-
-    # Status = CLOSED
-    cell_green = cell_white.copy()
-    cell_green['backgroundColor'] = {'red': 0, 'green': 1}
-
-    # Status = READY [user is ready].
-    cell_greenaccent = cell_white.copy()
-    cell_greenaccent['backgroundColor'] = {
+async def call(func, *args, cosmetic=False, retry=True, **kwargs):
+    '''Run a blocking gspread call on the sheet executor and await it.
+
+    Every call takes a token from the bucket first; cosmetic ones (formats)
+    have low priority. Rate limited and failing calls are retried with
+    jittered exponential backoff, unless retry is False: an append that
+    failed may have landed anyway, and retrying it would write the rows
+    twice. Raises asyncio.TimeoutError after SHEET_TIMEOUT seconds. The
+    thread may still finish the call later, but the bot does not wait on it.'''
+    loop = asyncio.get_running_loop()
+    for attempt in range(SHEET_RETRIES + 1 if retry else 1):
+        if await bucket.take(cosmetic):
+            stats['throttled'] += 1
+        stats['calls'] += 1
+        try:
+            return await asyncio.wait_for(
+                loop.run_in_executor(executor,
+                                     functools.partial(func, *args, **kwargs)),
+                SHEET_TIMEOUT)
+        except gspread.exceptions.APIError as e:
+            status = getattr(e.response, 'status_code', None)
+            if (not retry or status not in RETRY_STATUSES or
+                    attempt == SHEET_RETRIES):
+                raise
+            if status == 429:
+                bucket.drain()
+        stats['retried'] += 1
+        # Full jitter: anywhere up to the exponential backoff, so retries
+        # from a burst do not all come back at the same moment.
+        delay = random.uniform(0, min(64, 2 ** attempt))
+        logger.info('Sheets returned %d, retrying in %.1f seconds.',
+                    status, delay)
+        await asyncio.sleep(delay)
+
+
+# Row background colors by Status, set by conditional format rules.
+STATUS_COLORS = {
+    utils.Status.PENDING.name: {'red': 1, 'green': 1, 'blue': 1},
+    utils.Status.PROCESSING.name: {'red': 1, 'green': 1},
+    utils.Status.FOUND.name: {'red': 1, 'green': 0.6},
+    utils.Status.CLOSED.name: {'red': 0, 'green': 1},
+    # user is ready.
+    utils.Status.READY.name: {
         'red': 0.20392157,
         'green': 0.65882355,
         'blue': 0.3254902
-    }
-
-    # Status = CANCEL [user cancelled an application]
-    # Status = REJECTED [staff denied an application]
-    cell_gray = cell_white.copy()
-    cell_gray['backgroundColor'] = {'red': 0.6, 'green': 0.6, 'blue': 0.6}
-
-    # Status = APPROVED
-    cell_skyblue = cell_white.copy()
-    cell_skyblue['backgroundColor'] = {
+    },
+    # user cancelled or staff denied an application.
+    utils.Status.CANCEL.name: {'red': 0.6, 'green': 0.6, 'blue': 0.6},
+    utils.Status.REJECTED.name: {'red': 0.6, 'green': 0.6, 'blue': 0.6},
+    utils.Status.APPROVED.name: {
         'red': 0.5294,
         'green': 0.8078,
         'blue': 0.9804
+    },
+}
+# Text of applicants who cannot time travel is red.
+RED_TEXT = {'foregroundColor': {'red': 1}}
+# Set once the rules are on the worksheet.
+formatting_ready = False
+
+
+async def connect():
+    '''Open the client, spreadsheet and worksheet, unless already open.'''
+    global gc, sheet, wks
+    if gc is None:
+        if SHEET_BACKEND == 'fake':
+            gc = await call(fakesheet.service_account)
+        else:
+            gc = await call(gspread.service_account)
+    if sheet is None:
+        # Open a sheet from a spreadsheet in one go
+        sheet = await call(gc.open_by_key, GSHEET_ID)
+    if wks is None:
+        wks = await call(sheet.worksheet, GSHEET_WORKSHEET)
+    return wks
+
+
+async def warm_up():
+    '''Connect and read the row index in the background, i.e. after on_ready.'''
+    global available
+    async with sync_lock:
+        try:
+            await setup_formatting()
+            if row_index is None:
+                await load_rows()
+        except Exception as e:
+            available = False
+            logger.warning('Sheets is not reachable yet, changes will be '
+                           'queued: %s', str(e))
+    start_sync()
+
+
+async def load_rows():
+    '''Build row_index from one read of the Request Id column.'''
+    global row_index, last_row
+    await connect()
+    column = await call(wks.col_values, 1)
+    # Row 1 holds the headers.
+    row_index = {str(v): i for i, v in enumerate(column, start=1)
+                 if i > 1 and v}
+    last_row = len(column)
+    return row_index
+
+
+async def find_row(request_id):
+    '''Row number of an application in the sheet, or None.'''
+    if row_index is None:
+        await load_rows()
+    return row_index.get(str(request_id))
+
+
+def appended_rows(response):
+    '''Row numbers an append call wrote to, read from its updatedRange.'''
+    # i.e. 'Sheet1!A5:J6', or 'Sheet1!A5:J5' for a single row.
+    cells = response['updates']['updatedRange'].split('!')[-1].split(':')
+    first, last = (int(re.sub(r'\D', '', cell)) for cell in (cells[0], cells[-1]))
+    return range(first, last + 1)
+
+
+# Rows of applications in these statuses are hidden.
+ARCHIVED_STATUSES = (utils.Status.CLOSED.name, utils.Status.CANCEL.name,
+                     utils.Status.REJECTED.name)
+
+HEADERS = [
+    'Request Id', 'Name', 'Status', 'Villager', 'Created Time(UTC)',
+    'Time-Travel', 'Available Time(UTC)', 'Last Modified(UTC)', 'Staff',
+    'Notes'
+]
+# Columns staff may edit in the sheet; pull() brings them back to the store.
+EDITABLE = {'status': 2, 'staff': 8, 'notes': 9}
+LAST_COLUMN = chr(ord('A') + len(HEADERS) - 1)
+
+
+def row_range(row):
+    '''A1 range of a whole application row.'''
+    return "'{}'!A{}:{}{}".format(wks.title, row, LAST_COLUMN, row)
+
+
+def row_hash(values):
+    '''Digest of a row's cells, as the sheet shows them.'''
+    cells = [str(v).strip().lower() for v in values]
+    cells += [''] * (len(HEADERS) - len(cells))
+    return hashlib.sha1('\t'.join(cells).encode('utf-8')).hexdigest()
+
+
+def row_values(request_id, details):
+    '''Turn an application into the list of cells of its row.'''
+    new_data = []
+    new_data.append(str(request_id))
+    new_data.append(details['name'])
+    new_data.append(details['status'])
+    villager = details['villager']
+    # only need the name put in the sheet.
+    new_data.append(villager.split(',')[0])
+    # Older applications may miss these.
+    new_data.append(details.get('created_time', ''))
+    new_data.append(details.get('can_time_travel', ''))
+    new_data.append(details.get('avail_time', ''))
+    # normal case: some requests don't have a last_modified or staff yet.
+    new_data.append(details.get('last_modified', ''))
+    new_data.append(details.get('staff', ''))
+    new_data.append(details.get('notes', ''))
+    return new_data
+
+
+def format_request(cell_format, row=None):
+    '''A repeatCell request applying cell_format to columns A:J.
+
+    Of one row if given, else of the whole sheet.'''
+    cells = {
+        'sheetId': wks.id,
+        'startColumnIndex': 0,
+        'endColumnIndex': len(HEADERS),
+    }
+    if row:
+        cells['startRowIndex'] = row - 1
+        cells['endRowIndex'] = row
+    return {
+        'repeatCell': {
+            'range': cells,
+            'cell': {'userEnteredFormat': cell_format},
+            'fields': 'userEnteredFormat(%s)' % ','.join(cell_format),
+        }
+    }
+
+
+def format_rule(formula, cell_format):
+    '''A conditional format rule over every data row (row 2 and down).'''
+    return {
+        'ranges': [{
+            'sheetId': wks.id,
+            'startRowIndex': 1,
+            'startColumnIndex': 0,
+            'endColumnIndex': len(HEADERS),
+        }],
+        'booleanRule': {
+            'condition': {
+                'type': 'CUSTOM_FORMULA',
+                'values': [{'userEnteredValue': formula}],
+            },
+            'format': cell_format,
+        },
     }
 
-    if str(time_travel).lower() == 'false':
-        red_text_format = red_text_format
-    else:
-        red_text_format = None
-
-    if status == utils.Status.PENDING.name:
-        cell_color = cell_white
-    if status == utils.Status.PROCESSING.name:
-        cell_color = cell_yellow
-    if status == utils.Status.FOUND.name:
-        cell_color = cell_orange
-    if status == utils.Status.CLOSED.name:
-        cell_color = cell_green
-    if status == utils.Status.READY.name:
-        cell_color = cell_greenaccent
-    if status in (utils.Status.CANCEL.name, utils.Status.REJECTED.name):
-        cell_color = cell_gray
-    if status == utils.Status.APPROVED.name:
-        cell_color = cell_skyblue
-    return (cell_color, red_text_format)
+
+def rule_formula(rule):
+    try:
+        return rule['booleanRule']['condition']['values'][0]['userEnteredValue']
+    except (KeyError, IndexError):
+        return None
+
+
+def rule_key(rule):
+    # Its formula and how many columns it covers.
+    ranges = rule.get('ranges') or [{}]
+    return rule_formula(rule), ranges[0].get('endColumnIndex')
+
+
+def format_rules():
+    '''Rules coloring a row by its Status (C), red text by Time-Travel (F).
+
+    Only the first matching rule applies to a cell, so the red text rules
+    carry the status color too and come first.'''
+    red_rules = []
+    rules = []
+    for status, color in STATUS_COLORS.items():
+        red_rules.append(format_rule(
+            '=AND($C2="%s",LOWER($F2&"")="false")' % status,
+            {'backgroundColor': color, 'textFormat': RED_TEXT}))
+        rules.append(format_rule('=$C2="%s"' % status,
+                                 {'backgroundColor': color}))
+    return red_rules + rules
+
+
+async def setup_formatting():
+    '''Install the conditional format rules and static formats, once.
+
+    After this, writing a row never needs a formatting call. Rules we put
+    there before are replaced when they changed; other rules are left alone.'''
+    global formatting_ready
+    if formatting_ready:
+        return
+    await connect()
+    response = await call(sheet.fetch_sheet_metadata, {
+        'fields': 'sheets(properties.sheetId,conditionalFormats)'})
+    existing = []
+    for worksheet in response.get('sheets', []):
+        if worksheet['properties']['sheetId'] == wks.id:
+            existing = worksheet.get('conditionalFormats', [])
+    rules = format_rules()
+    ours = [i for i, rule in enumerate(existing)
+            if '$C2' in (rule_formula(rule) or '')]
+    if [rule_key(existing[i]) for i in ours] != list(map(rule_key, rules)):
+        # Delete from the end, so the indexes of the rest stay put.
+        requests = [{'deleteConditionalFormatRule': {'sheetId': wks.id,
+                                                     'index': i}}
+                    for i in reversed(ours)]
+        requests += [{'addConditionalFormatRule': {'rule': rule, 'index': i}}
+                     for i, rule in enumerate(rules)]
+        requests.append(format_request({'horizontalAlignment': 'CENTER'}))
+        requests.append(format_request({'textFormat': {'bold': True}}, 1))
+        await call(sheet.batch_update, {'requests': requests}, cosmetic=True)
+        logger.info('Installed %d conditional format rules.', len(rules))
+    formatting_ready = True
 
 
 async def update_data(data):
-    '''Update a single row in the spreadsheet and fill changes up with passed data.'''
-    last_modified = ''
-    new_data = []
+    '''Update rows in the spreadsheet and fill changes up with passed data.
+
+    All values go out in one batched values update, whatever the number of
+    applications. Colors come from the conditional format rules.'''
+    await setup_formatting()
+    value_ranges = []
+    new_rows = []
+    global last_row
     for request_id, details in data.items():
-        new_data.append(str(request_id))
-        new_data.append(details['name'])
-        new_data.append(details['status'])
-        villager = details['villager']
-        # only need the name put in the sheet.
-        new_data.append(villager.split(',')[0])
-        new_data.append(details['created_time'])
-        new_data.append(details['can_time_travel'])
-        new_data.append(details['avail_time'])
-        try:
-            new_data.append(details['last_modified'])
-        except KeyError:
-            # normal case: some requests don't have a last_modified data yet.
-            pass
-        try:
-            new_data.append(details['staff'])
-        except KeyError:
-            # safe to pass because some data don't have staff info.
-            pass
-    try:
-        # Updating an existing data.
-        cell = wks.find(str(request_id))
-        row = cell.row
-        for i in range(1, len(new_data) + 1):
-            wks.update_cell(row, i, new_data[i - 1])
-        wks.format('A:I', {"horizontalAlignment": "CENTER"})
-        color, red_text = format_color(details['status'],
-                                       details['can_time_travel'])
-        data_range = 'A{}:I{}'.format(row, row)
-        # Update color and text format.
-        wks.format(data_range, color)
-        if red_text:
-            wks.format(data_range, red_text)
-    except gspread.exceptions.CellNotFound:
+        new_data = row_values(request_id, details)
+        row = await find_row(request_id)
+        if row:
+            # Updating an existing data.
+            value_ranges.append({
+                'range': row_range(row),
+                'values': [new_data],
+            })
+        else:
+            new_rows.append((request_id, new_data, details))
+        row_hashes[str(request_id)] = row_hash(new_data)
+    if new_rows:
         # Appending new data
-        all_data = wks.get_all_records()
-        if not all_data:
+        rows = [new_data for _, new_data, _ in new_rows]
+        if not last_row:
             # write headers first..
-            wks.append_row([
-                'Request Id', 'Name', 'Status', 'Villager',
-                'Created Time(UTC)', 'Time-Travel', 'Available Time(UTC)',
-                'Last Modified(UTC)', 'Staff'
-            ])
-            wks.format('A1:I1', {'textFormat': {'bold': True}})
-        wks.append_row(new_data)
-        wks.format('A:I', {"horizontalAlignment": "CENTER"})
-
-        color, red_text = format_color(details['status'],
-                                       details['can_time_travel'])
-        # Headers don't count as data.
-        # And we've insert a new row, so move 2 by the length.
-        row = len(all_data) + 2
-        data_range = 'A{}:I{}'.format(row, row)
-        # Update color and text format.
-        wks.format(data_range, color)
-        if red_text:
-            wks.format(data_range, red_text)
+            rows.insert(0, HEADERS)
+        response = await call(wks.append_rows, rows, retry=False)
+        # Take the rows from the response, in case the table did not end
+        # where we thought it did.
+        written = list(appended_rows(response))[-len(new_rows):]
+        for row, (request_id, _, _) in zip(written, new_rows):
+            row_index[str(request_id)] = row
+        last_row = max(last_row, written[-1])
+    if value_ranges:
+        await call(sheet.values_batch_update, {
+            'valueInputOption': 'USER_ENTERED',
+            'data': value_ranges,
+        })
 
 
 async def insert_note(request_id, notes):
-    '''Insert notes to an application case.'''
-    pass
+    '''Insert notes to an application case.
 
+    Only the Notes cell is written, with the next sync. The note should be
+    saved on the application in the store too, or pull() and reconcile()
+    will put the old one back.'''
+    pending_notes[str(request_id)] = notes
+    start_sync()
 
-async def archive_column(request_id, hide=True):
-    '''Archive a column to hide from user views.'''
-    # Assuming request_id should exist in the sheet already.
-    cell = wks.find(str(request_id))
-    row = cell.row
-    requests = [{
+
+async def write_notes(notes):
+    '''Write many Notes cells in one call.'''
+    await connect()
+    value_ranges = []
+    column = chr(ord('A') + EDITABLE['notes'])
+    for request_id, note in notes.items():
+        row = await find_row(request_id)
+        if not row:
+            logger.warning('Cannot add a note to %s: it is not in the sheet.',
+                           request_id)
+            continue
+        value_ranges.append({
+            'range': "'{}'!{}{}".format(wks.title, column, row),
+            'values': [[note]],
+        })
+        # The row changed from what was last seen; forget it, so pull()
+        # takes what it reads next as the new baseline.
+        row_hashes.pop(str(request_id), None)
+    if value_ranges:
+        await call(sheet.values_batch_update, {
+            'valueInputOption': 'USER_ENTERED',
+            'data': value_ranges,
+        })
+
+
+def hide_request(first, last=None, hide=True):
+    '''An updateDimensionProperties request hiding or showing rows first..last.'''
+    return {
         'updateDimensionProperties': {
             "range": {
                 "sheetId": wks.id,
                 "dimension": 'ROWS',
-                "startIndex": row - 1,
-                "endIndex": row,
+                "startIndex": first - 1,
+                "endIndex": last or first,
             },
             "properties": {
                 "hiddenByUser": hide,
             },
             "fields": 'hiddenByUser',
         }
-    }]
-    sheet.batch_update({'requests': requests})
+    }
+
+
+def row_runs(rows):
+    '''Merge row numbers into (first, last) runs of contiguous rows.'''
+    runs = []
+    for row in sorted(set(rows)):
+        if runs and row == runs[-1][1] + 1:
+            runs[-1] = (runs[-1][0], row)
+        else:
+            runs.append((row, row))
+    return runs
+
+
+def hide_requests(rows, hide=True):
+    '''Requests hiding or showing rows, one per run of contiguous rows.'''
+    return [hide_request(first, last, hide) for first, last in row_runs(rows)]
+
+
+async def archive_rows(request_ids, hide=True):
+    '''Hide (or show) the rows of many applications in a single request.
+
+    Neighbouring rows are merged into one range. Returns how many rows were
+    found in the sheet.'''
+    # Assuming request_ids should exist in the sheet already.
+    await connect()
+    rows = []
+    for request_id in request_ids:
+        row = await find_row(request_id)
+        if not row:
+            logger.warning('Cannot archive %s: it is not in the sheet.',
+                           request_id)
+            continue
+        rows.append(row)
+    requests = hide_requests(rows, hide)
+    if requests:
+        await call(sheet.batch_update, {'requests': requests})
+    return len(rows)
+
+
+async def archive_column(request_id, hide=True):
+    '''Archive a column to hide from user views.'''
+    return await archive_rows([request_id], hide)
+
+
+def same_cell(expected, actual):
+    '''Compare a value we would write with what the sheet shows.'''
+    actual = '' if actual is None else actual
+    return str(expected).strip().lower() == str(actual).strip().lower()
+
+
+async def read_sheet():
+    '''Read every row's values and hidden state at once.
+
+    Returns a list of (values, hidden) tuples, headers included.'''
+    await connect()
+    fields = ('sheets.data(rowMetadata.hiddenByUser,'
+              'rowData.values.formattedValue)')
+    response = await call(sheet.fetch_sheet_metadata, {
+        'ranges': "'{}'!A:{}".format(wks.title, LAST_COLUMN),
+        'includeGridData': 'true',
+        'fields': fields,
+    })
+    data = response['sheets'][0]['data'][0]
+    metadata = data.get('rowMetadata', [])
+    found = []
+    for i, row in enumerate(data.get('rowData', [])):
+        cells = row.get('values', [])
+        values = [c.get('formattedValue', '') for c in cells]
+        hidden = i < len(metadata) and metadata[i].get('hiddenByUser', False)
+        found.append((values, hidden))
+    return found
+
+
+async def reconcile(data):
+    '''Make the sheet match the store: {request_id: details} of every application.
+
+    The sheet is read once, then every row that differs in values or hidden
+    state is fixed and missing applications are appended, all in at most
+    three more calls. Colors come from the conditional format rules, which
+    are checked and put back if they went missing. The row index is rebuilt
+    along the way. Returns counts of what was fixed.'''
+    global row_index, last_row, formatting_ready
+    async with sync_lock:
+        formatting_ready = False
+        await setup_formatting()
+        rows = await read_sheet()
+        row_index = {str(values[0]): i
+                     for i, (values, _) in enumerate(rows, start=1)
+                     if i > 1 and values and values[0]}
+        last_row = len(rows)
+        result = {'updated': 0, 'added': 0, 'hidden': 0,
+                  'unknown': len(set(row_index) - set(data))}
+        value_ranges = []
+        # Rows to hide or show again, by their hidden state to be.
+        toggles = {True: [], False: []}
+        missing = dict()
+        for request_id, details in data.items():
+            row = row_index.get(str(request_id))
+            if not row:
+                # Finished ones may have been rotated into an archive
+                # worksheet; only active applications must be here.
+                if details['status'] not in ARCHIVED_STATUSES:
+                    missing[request_id] = details
+                continue
+            values, hidden = rows[row - 1]
+            expected = row_values(request_id, details)
+            values = values + [''] * (len(expected) - len(values))
+            if not all(same_cell(e, v) for e, v in zip(expected, values)):
+                value_ranges.append({
+                    'range': row_range(row),
+                    'values': [expected],
+                })
+                row_hashes[str(request_id)] = row_hash(expected)
+                result['updated'] += 1
+            archived = details['status'] in ARCHIVED_STATUSES
+            if archived != hidden:
+                toggles[archived].append(row)
+                result['hidden'] += 1
+        if missing:
+            # Appended like any other new row.
+            await update_data(missing)
+            result['added'] = len(missing)
+        if value_ranges:
+            await call(sheet.values_batch_update, {
+                'valueInputOption': 'USER_ENTERED',
+                'data': value_ranges,
+            })
+        requests = hide_requests(toggles[True]) + hide_requests(toggles[False],
+                                                                hide=False)
+        if requests:
+            await call(sheet.batch_update, {'requests': requests})
+    return result
+
+
+async def pull():
+    '''Read the sheet in one call and return the rows staff edited in it.
+
+    Returns {request_id: {'status': .., 'staff': .., 'notes': ..}} for rows
+    whose content changed since they were last written or read. Rows seen
+    for the first time, i.e. after a restart, have no such baseline: they
+    are returned too, with their 'last_modified', for the caller to compare
+    with the store. When the bot has a change of its own queued for a row,
+    the bot wins: the row is left out and the next flush overwrites it. The row index is refreshed from the same read, so
+    rows sorted by hand are found again.'''
+    global row_index, last_row
+    async with sync_lock:
+        await connect()
+        response = await call(sheet.values_get,
+                              "'{}'!A1:{}".format(wks.title, LAST_COLUMN))
+        rows = response.get('values', [])
+        if rows and rows[0] != HEADERS:
+            # i.e. a sheet from before the Notes column.
+            await call(sheet.values_batch_update, {
+                'valueInputOption': 'USER_ENTERED',
+                'data': [{'range': row_range(1), 'values': [HEADERS]}],
+            })
+        row_index = {str(values[0]): i
+                     for i, values in enumerate(rows, start=1)
+                     if i > 1 and values and values[0]}
+        last_row = len(rows)
+        changed = dict()
+        for values in rows[1:]:
+            if not values or not values[0]:
+                continue
+            request_id = str(values[0])
+            digest = row_hash(values)
+            seen = row_hashes.get(request_id)
+            row_hashes[request_id] = digest
+            if seen == digest:
+                continue
+            if request_id in pending_updates or request_id in pending_notes:
+                logger.info('%s was changed in the sheet and by the bot; '
+                            'keeping the bot\'s change.', request_id)
+                continue
+            values = values + [''] * (len(HEADERS) - len(values))
+            changed[request_id] = {k: values[i] for k, i in EDITABLE.items()}
+            if seen is None:
+                changed[request_id]['last_modified'] = values[7]
+    return changed
+
+
+def period_title(row, period=None):
+    '''Name of the archive worksheet a finished row is rotated into.'''
+    period = period or SHEET_ARCHIVE_PERIOD
+    # Last Modified, or Created Time if it was never modified.
+    values = row + [''] * (len(HEADERS) - len(row))
+    try:
+        tm = time.strptime(values[7] or values[4], TIME_FORMAT)
+    except (TypeError, ValueError):
+        return 'Archive'
+    if period == 'quarter':
+        return 'Archive %d-Q%d' % (tm.tm_year, (tm.tm_mon - 1) // 3 + 1)
+    return 'Archive %d-%02d' % (tm.tm_year, tm.tm_mon)
+
+
+async def rotate(period=None):
+    '''Move every finished row out of the main worksheet, in bulk.
+
+    Rows go into per-period archive worksheets, so the main one only holds
+    active applications. That is one read, one call to create missing
+    worksheets, one append per period and one delete, however many rows
+    move. Returns {worksheet title: rows moved}.'''
+    global row_index, last_row
+    async with sync_lock:
+        await connect()
+        rows = await read_sheet()
+        moving = dict()
+        for i, (values, _) in enumerate(rows, start=1):
+            if i > 1 and len(values) > 2 and values[2] in ARCHIVED_STATUSES:
+                moving.setdefault(period_title(values, period), []).append(
+                    (i, values))
+        if not moving:
+            return dict()
+        titles = [w.title for w in await call(sheet.worksheets)]
+        new_titles = [t for t in moving if t not in titles]
+        if new_titles:
+            await call(sheet.batch_update, {'requests': [
+                {'addSheet': {'properties': {'title': t}}}
+                for t in new_titles]})
+        for title, moved in moving.items():
+            values = [v for _, v in moved]
+            if title in new_titles:
+                values.insert(0, HEADERS)
+            await call(sheet.values_append, "'{}'!A1".format(title),
+                       {'valueInputOption': 'USER_ENTERED'},
+                       {'values': values}, retry=False)
+        # Copied first, deleted after: a failure in between leaves the rows
+        # in both places rather than in neither. Delete bottom up, so the
+        # rows above keep their numbers.
+        moved_rows = [i for moved in moving.values() for i, _ in moved]
+        await call(sheet.batch_update, {'requests': [{
+            'deleteDimension': {
+                'range': {
+                    'sheetId': wks.id,
+                    'dimension': 'ROWS',
+                    'startIndex': first - 1,
+                    'endIndex': last,
+                }
+            }
+        } for first, last in reversed(row_runs(moved_rows))]})
+        moved_rows = set(moved_rows)
+        kept = [values for i, (values, _) in enumerate(rows, start=1)
+                if i not in moved_rows]
+        row_index = {str(values[0]): i for i, values in enumerate(kept, start=1)
+                     if i > 1 and values and values[0]}
+        last_row = len(kept)
+    result = {title: len(moved) for title, moved in moving.items()}
+    logger.info('Rotated finished rows into archive worksheets: %s', result)
+    return result
+
+
+def queue_update(data):
+    '''Queue rows for the sync task instead of writing them now.'''
+    for request_id, details in data.items():
+        pending_updates[str(request_id)] = details
+    start_sync()
+
+
+def queue_archive(request_id, hide=True):
+    '''Queue a row to be hidden (or shown again) by the sync task.'''
+    pending_archives[str(request_id)] = hide
+    start_sync()
+
+
+def start_sync():
+    '''Start the sync task, once.'''
+    global sync_task
+    if sync_task is None:
+        sync_task = asyncio.ensure_future(sync())
+
+
+async def sync():
+    '''Push queued changes to the sheet every SYNC_SECONDS.'''
+    while True:
+        await asyncio.sleep(SYNC_SECONDS)
+        await flush()
+
+
+async def flush():
+    '''Write every queued change now: rows first, then their hidden state.
+
+    If the sheet fails, the changes are queued again for the next round,
+    unless a newer change to the same application came in meanwhile. While
+    Sheets stays down that is all that happens; only going down and coming
+    back are logged.'''
+    global pending_updates, pending_archives, pending_notes, available
+    global row_index
+    async with sync_lock:
+        updates, pending_updates = pending_updates, dict()
+        archives, pending_archives = pending_archives, dict()
+        # A full row write carries the notes already.
+        notes = {k: v for k, v in pending_notes.items() if k not in updates}
+        pending_notes = dict()
+        if not updates and not archives and not notes:
+            return
+        try:
+            if updates:
+                await update_data(updates)
+            if notes:
+                await write_notes(notes)
+            for hide in (True, False):
+                request_ids = [k for k, v in archives.items() if v == hide]
+                if request_ids:
+                    await archive_rows(request_ids, hide)
+        except Exception as e:
+            if available:
+                logger.error('Failed to sync %d rows to the sheet, queueing '
+                             'changes until it is back: %s',
+                             len(updates) + len(archives) + len(notes), str(e))
+            available = False
+            # An append may have landed even though it failed or timed out.
+            # Read the Request Id column again before anything is appended,
+            # so those rows are updated instead of appended twice.
+            row_index = None
+            for request_id, details in updates.items():
+                pending_updates.setdefault(request_id, details)
+            for request_id, hide in archives.items():
+                pending_archives.setdefault(request_id, hide)
+            for request_id, note in notes.items():
+                pending_notes.setdefault(request_id, note)
+            return
+        if not available:
+            logger.info('Sheets is back, synced %d queued rows.',
+                        len(updates) + len(archives) + len(notes))
+        available = True
+
+
+async def close():
+    '''Stop the sync task, write whatever is still queued and stop the threads.'''
+    global sync_task
+    if sync_task is not None:
+        sync_task.cancel()
+        sync_task = None
+    await flush()
+    executor.shutdown(wait=False)
@@ -0,0 +1,920 @@
+'''A resident store of applications, backed by an append-only journal.
+
+Only active applications are kept in memory. Closed, cancelled and rejected
+ones are moved to an append-only archive file, and found again through a
+small index of where each one sits in it.'''
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import json
+import logging
+import os
+import re
+import sqlite3
+import sys
+import zlib
+
+from dotenv import load_dotenv
+
+from ext import utils
+from ext.application import Application, load_time
+
+load_dotenv()
+# Sitting in the parent directory where bot.py runs.
+RECORD_FILE = os.getenv('RECORD_FILE')
+# Compacted state of RECORD_FILE. The journal only holds changes made after it.
+SNAPSHOT_FILE = os.getenv('SNAPSHOT_FILE') or '%s.snapshot' % RECORD_FILE
+# Fold the journal into a new snapshot after this many appended entries.
+COMPACT_EVERY = int(os.getenv('COMPACT_EVERY') or 500)
+# Where finished applications are moved to.
+ARCHIVE_FILE = os.getenv('ARCHIVE_FILE') or '%s.archive' % RECORD_FILE
+# Applications in these statuses are finished and live in the archive.
+ARCHIVED_STATUSES = (utils.Status.CLOSED, utils.Status.CANCEL,
+                     utils.Status.REJECTED)
+
+logger = logging.getLogger('bot')
+
+
+class ConflictError(Exception):
+    '''An application changed after it was read, so an update was refused.'''
+    def __init__(self, request_id):
+        super().__init__('Application **%s** was changed by someone else in '
+                         'the meantime. Please check it again and retry.'
+                         % request_id)
+        self.request_id = request_id
+
+
+def encode_line(request_id, details):
+    '''Form a journal line: the record as JSON, a tab, then its CRC32.'''
+    payload = json.dumps({request_id: details}, indent=None)
+    return '%s\t%08x\n' % (payload, zlib.crc32(payload.encode('utf-8')))
+
+
+def decode_line(line):
+    '''Parse a journal line back to (request_id, details).
+
+    Lines written before checksums were added have no tab and are trusted as
+    they are. Raises ValueError when a line is torn or does not match its
+    checksum.'''
+    payload, sep, checksum = line.rpartition('\t')
+    if not sep:
+        payload = line
+    elif '%08x' % zlib.crc32(payload.encode('utf-8')) != checksum:
+        raise ValueError('checksum mismatch')
+    line_dict = json.loads(payload)
+    return list(line_dict)[0], list(line_dict.values())[0]
+
+
+def normalize_name(name):
+    '''Normalize an applicant name such as "foxfair#2155" for the name index.'''
+    return str(name).strip().lower()
+
+
+def normalize_villager(villager):
+    '''Normalize a "Name, URL" villager field down to its lowercased name.'''
+    return str(villager).split(',')[0].strip().lower()
+
+
+def to_status(status):
+    '''Accept a utils.Status member or its name, in any case.'''
+    if isinstance(status, utils.Status):
+        return status
+    return utils.Status[str(status).upper()]
+
+
+def write_atomic(path, lines):
+    '''Replace a file with lines so readers see either the old or new file.'''
+    tmp_path = '%s.tmp' % path
+    with open(tmp_path, mode='w') as f:
+        f.writelines(lines)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    # Make the rename itself durable.
+    dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+class ApplicationStore:
+    '''Keep active applications in memory and journal each change to disk.
+
+    On disk the state is a snapshot plus a journal of later changes, both
+    using one {request_id: details} object per line. Replaying the journal
+    on top of the snapshot, with later lines winning, gives back the current
+    state of every active application.
+
+    An application that reaches one of ARCHIVED_STATUSES is appended to the
+    archive file and dropped from memory; only its offset, user id, name and
+    status are kept, enough to find it again. If an application shows up in
+    both, the active copy wins.'''
+    def __init__(self, path, snapshot_path=None, archive_path=None):
+        self.path = path
+        self.snapshot_path = snapshot_path or '%s.snapshot' % path
+        self.archive_path = archive_path or '%s.archive' % path
+        # Keyed by request_id, and its value is an Application.
+        self.data = dict()
+        # Secondary indexes: key -> {request_id: None}, kept in insertion
+        # order so lookups list applications in the order they were created.
+        self.user_index = dict()
+        self.name_index = dict()
+        self.status_index = dict()
+        # Archived applications: request_id -> (offset, user_id, name, status).
+        # The offset is None until the line is written; until then the record
+        # waits in self.archive_pending.
+        self.archive = dict()
+        self.archive_pending = dict()
+        self.archive_user_index = dict()
+        self.archive_name_index = dict()
+        self.archive_status_index = dict()
+        # How many journal entries were written since the last snapshot.
+        self.journal_len = 0
+        # Disk writes run one at a time on this thread, fed by self.queue, so
+        # commands never block the event loop on file I/O.
+        self.executor = ThreadPoolExecutor(max_workers=1,
+                                           thread_name_prefix='store')
+        self.queue = None
+        self.writer_task = None
+        # request_id -> [details, undo] of each save not on disk yet, oldest
+        # first, so a failed write can put memory back the way it was.
+        self.inflight = dict()
+
+    def _read_lines(self, path, tail=False):
+        '''Yield (offset, Application) for every valid line of a file.
+
+        For the journal and the archive (tail=True) a bad last line is a
+        write cut short by a crash; it is cut off so the next append starts
+        on a clean line. A good last line that only misses its line ending
+        (i.e. a hand-edited record.txt) is kept and the ending is added.'''
+        offset = 0
+        torn_at = None
+        unterminated = False
+        with open(path, mode='rb') as f:
+            for raw in f:
+                start, offset = offset, offset + len(raw)
+                torn_at = None
+                unterminated = not raw.endswith(b'\n')
+                line = raw.decode('utf-8', errors='replace').strip()
+                if not line:
+                    continue
+                try:
+                    request_id, details = decode_line(line)
+                    app = Application.from_record(request_id, details)
+                except (KeyError, ValueError) as e:
+                    logger.warning('Skipped a bad line in %s at byte %d: %s',
+                                   path, start, str(e))
+                    torn_at = start
+                    continue
+                yield start, app
+        if tail and torn_at is not None:
+            with open(path, mode='rb+') as f:
+                f.truncate(torn_at)
+        elif tail and unterminated:
+            with open(path, mode='ab') as f:
+                f.write(b'\n')
+
+    def _replay(self, path, tail=False):
+        '''Apply every valid line of a file, returning how many were read.'''
+        count = 0
+        for _, app in self._read_lines(path, tail):
+            self._put(app)
+            count += 1
+        return count
+
+    def load(self):
+        '''Load the newest snapshot, then replay the journal written after it.'''
+        self.data = dict()
+        self.user_index = dict()
+        self.name_index = dict()
+        self.status_index = dict()
+        self.archive = dict()
+        self.archive_pending = dict()
+        self.archive_user_index = dict()
+        self.archive_name_index = dict()
+        self.archive_status_index = dict()
+        self.journal_len = 0
+        if os.path.exists(self.archive_path):
+            for offset, app in self._read_lines(self.archive_path, tail=True):
+                self._archive_put(app, offset)
+        if os.path.exists(self.snapshot_path):
+            self._replay(self.snapshot_path)
+        if os.path.exists(self.path):
+            self.journal_len = self._replay(self.path, tail=True)
+        # Finished applications still in the journal or snapshot, e.g. from a
+        # record.txt written before the archive existed, are moved over now.
+        finished = [app for app in self.data.values()
+                    if app.status in ARCHIVED_STATUSES]
+        moving = []
+        for app in finished:
+            self._drop(app.request_id)
+            archived = self._archive_read(app.request_id)
+            if archived is None or archived.to_record() != app.to_record():
+                moving.append(app)
+        for request_id in self.data:
+            self._archive_drop(request_id)
+        if moving:
+            offsets = self._append_archive(
+                [(app.request_id, app.to_record(), None) for app in moving])
+            for app in moving:
+                self._archive_put(app, offsets[app.request_id])
+            logger.info('Archived %d finished applications', len(moving))
+        if finished or self.journal_len >= COMPACT_EVERY:
+            self.compact()
+
+    def compact(self, snapshot=None):
+        '''Fold the journal into a fresh snapshot and start an empty journal.
+
+        The snapshot is renamed into place before the journal is emptied. A
+        crash in between only means the same journal is replayed again on
+        top of the new snapshot, which gives the same state.'''
+        snapshot = snapshot if snapshot is not None else self._snapshot()
+        write_atomic(self.snapshot_path,
+                     [encode_line(app.request_id, app.to_record())
+                      for app in snapshot])
+        write_atomic(self.path, [])
+        self.journal_len = 0
+        logger.info('Compacted %d applications into %s',
+                    len(snapshot), self.snapshot_path)
+
+    def _snapshot(self):
+        '''Copy what compact() needs while still on the event loop.
+
+        Finished applications still waiting for their archive line go in
+        too: the journal is emptied, so otherwise no file would hold them.
+        load() moves them to the archive again.'''
+        return list(self.data.values()) + [
+            Application.from_record(k, v)
+            for k, v in self.archive_pending.items()]
+
+    def _index_keys(self, app):
+        '''Yield (index, key) pairs an application is filed under.'''
+        yield self.user_index, app.user_id
+        yield self.name_index, normalize_name(app.name)
+        yield self.status_index, app.status
+
+    def _put(self, app):
+        '''Replace an application in memory and move it between index keys.'''
+        request_id = app.request_id
+        old = self.data.get(request_id)
+        if old is not None:
+            for index, key in self._index_keys(old):
+                bucket = index.get(key)
+                if bucket is not None:
+                    bucket.pop(request_id, None)
+                    if not bucket:
+                        del index[key]
+        self.data[request_id] = app
+        for index, key in self._index_keys(app):
+            index.setdefault(key, dict())[request_id] = None
+
+    def _drop(self, request_id):
+        '''Remove an application from memory and from every index.'''
+        old = self.data.pop(request_id, None)
+        if old is not None:
+            for index, key in self._index_keys(old):
+                bucket = index.get(key)
+                if bucket is not None:
+                    bucket.pop(request_id, None)
+                    if not bucket:
+                        del index[key]
+
+    def _archive_put(self, app, offset=None):
+        '''File an archived application under its user, name and status.'''
+        self._archive_file(app.request_id, (offset, app.user_id,
+                                            normalize_name(app.name),
+                                            app.status))
+
+    def _archive_file(self, request_id, entry):
+        self._archive_drop(request_id)
+        self.archive[request_id] = entry
+        for index, key in zip((self.archive_user_index,
+                               self.archive_name_index,
+                               self.archive_status_index), entry[1:]):
+            index.setdefault(key, dict())[request_id] = None
+
+    def _archive_drop(self, request_id):
+        '''Forget an archived application, e.g. when it was reopened.'''
+        entry = self.archive.pop(request_id, None)
+        self.archive_pending.pop(request_id, None)
+        if entry is None:
+            return
+        for index, key in zip((self.archive_user_index,
+                               self.archive_name_index,
+                               self.archive_status_index), entry[1:]):
+            bucket = index.get(key)
+            if bucket is not None:
+                bucket.pop(request_id, None)
+                if not bucket:
+                    del index[key]
+
+    def _memory(self, request_id):
+        '''What memory holds for an application, for _restore().'''
+        return (self.data.get(request_id), self.archive.get(request_id),
+                self.archive_pending.get(request_id))
+
+    def _restore(self, request_id, undo):
+        '''Put back what memory held for an application before a failed write.'''
+        active, entry, pending = undo
+        self._drop(request_id)
+        self._archive_drop(request_id)
+        if active is not None:
+            self._put(active)
+        elif pending is not None:
+            # Still queued itself; the writer knows it by this same dict.
+            self._archive_put(Application.from_record(request_id, pending))
+            self.archive_pending[request_id] = pending
+        elif entry is not None:
+            self._archive_file(request_id, entry)
+
+    def _archive_read(self, request_id):
+        '''Read one archived application back, or None if it is not there.'''
+        if request_id in self.archive_pending:
+            return Application.from_record(request_id,
+                                           self.archive_pending[request_id])
+        entry = self.archive.get(request_id)
+        if entry is None or entry[0] is None:
+            return None
+        with open(self.archive_path, mode='rb') as f:
+            f.seek(entry[0])
+            line = f.readline().decode('utf-8')
+        return Application.from_record(*decode_line(line.strip()))
+
+    def _archive_read_many(self, request_ids):
+        '''Read many archived applications back in one pass over the archive.
+
+        The lines are read in file order; the result keeps the order of
+        request_ids. May run on the writer thread.'''
+        pending = dict(self.archive_pending)
+        archive = dict(self.archive)
+        found = dict()
+        offsets = []
+        for request_id in request_ids:
+            if request_id in pending:
+                found[request_id] = Application.from_record(
+                    request_id, pending[request_id])
+            elif archive.get(request_id, (None,))[0] is not None:
+                offsets.append((archive[request_id][0], request_id))
+        if offsets:
+            with open(self.archive_path, mode='rb') as f:
+                for offset, request_id in sorted(offsets):
+                    f.seek(offset)
+                    line = f.readline().decode('utf-8')
+                    found[request_id] = Application.from_record(
+                        *decode_line(line.strip()))
+        return [found[k] for k in request_ids if k in found]
+
+    async def read_archive(self, request_ids):
+        '''_archive_read_many() on the writer thread, off the event loop.'''
+        if not request_ids:
+            return []
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor,
+                                          self._archive_read_many,
+                                          list(request_ids))
+
+    def _archive_lookup(self, index, key):
+        return self._archive_read_many(list(index.get(key, ())))
+
+    def _store(self, app, details):
+        '''Put an application in memory or in the archive, by its status.
+
+        An archived one waits in archive_pending until its line is written.'''
+        if app.status in ARCHIVED_STATUSES:
+            self._drop(app.request_id)
+            self._archive_put(app)
+            self.archive_pending[app.request_id] = details
+        else:
+            self._archive_drop(app.request_id)
+            self._put(app)
+
+    def _lookup(self, index, key):
+        return [self.data[k] for k in index.get(key, ())]
+
+    def by_user(self, user_id, archived=False):
+        '''List the active applications by a discord user id.
+
+        With archived=True, the user's finished applications are read back
+        from the archive and listed after them.'''
+        found = self._lookup(self.user_index, user_id)
+        if archived:
+            found += self._archive_lookup(self.archive_user_index, user_id)
+        return found
+
+    def by_status(self, *statuses):
+        '''List every application in any of these statuses (names or members).
+
+        Finished statuses are read back from the archive.'''
+        found = []
+        for status in statuses:
+            status = to_status(status)
+            if status in ARCHIVED_STATUSES:
+                found += self._archive_lookup(self.archive_status_index,
+                                              status)
+            else:
+                found += self._lookup(self.status_index, status)
+        return found
+
+    async def read_by_user(self, user_id):
+        '''by_user(user_id, archived=True), reading the archive off the loop.'''
+        return self.by_user(user_id) + await self.read_archive(
+            list(self.archive_user_index.get(user_id, ())))
+
+    async def read_by_status(self, *statuses):
+        '''by_status(), reading finished statuses off the event loop.'''
+        found = []
+        for status in statuses:
+            status = to_status(status)
+            if status in ARCHIVED_STATUSES:
+                found += await self.read_archive(
+                    list(self.archive_status_index.get(status, ())))
+            else:
+                found += self._lookup(self.status_index, status)
+        return found
+
+    def by_name(self, name):
+        '''List active applications whose applicant name is exactly this name.'''
+        return self._lookup(self.name_index, normalize_name(name))
+
+    def search_name(self, pattern):
+        '''List applications whose applicant name matches a regex pattern.
+
+        Only the distinct names are searched, not every application, and
+        archived applications are only read for the names that match.'''
+        found = []
+        for name in list(self.name_index):
+            if re.search(pattern, name, re.IGNORECASE):
+                found += self._lookup(self.name_index, name)
+        for name in list(self.archive_name_index):
+            if re.search(pattern, name, re.IGNORECASE):
+                found += self._archive_lookup(self.archive_name_index, name)
+        return found
+
+    async def read_search_name(self, pattern):
+        '''search_name(), reading the archived matches off the event loop.'''
+        found = []
+        archived = []
+        for name in list(self.name_index):
+            if re.search(pattern, name, re.IGNORECASE):
+                found += self._lookup(self.name_index, name)
+        for name in list(self.archive_name_index):
+            if re.search(pattern, name, re.IGNORECASE):
+                archived += list(self.archive_name_index[name])
+        return found + await self.read_archive(archived)
+
+    def count(self, status):
+        '''Count applications in a status.'''
+        status = to_status(status)
+        if status in ARCHIVED_STATUSES:
+            return len(self.archive_status_index.get(status, ()))
+        return len(self.status_index.get(status, ()))
+
+    def get(self, request_id):
+        '''Return a copy of an application, or None if it does not exist.
+
+        A copy lets commands edit the application and still back out before
+        calling update(). Archived applications are read from the archive.'''
+        request_id = str(request_id)
+        app = self.data.get(request_id)
+        if app is not None:
+            return app.copy()
+        return self._archive_read(request_id)
+
+    def all(self):
+        '''List every active application, in the order they were created.
+
+        These are the stored objects; copy() one before changing it.'''
+        return list(self.data.values())
+
+    def archived(self):
+        '''List every archived application, reading the archive once.'''
+        # Copied first, as this may run on the writer thread.
+        pending = dict(self.archive_pending)
+        archive = dict(self.archive)
+        found = [Application.from_record(k, v) for k, v in pending.items()]
+        if os.path.exists(self.archive_path):
+            for offset, app in self._read_lines(self.archive_path):
+                entry = archive.get(app.request_id)
+                if entry is not None and entry[0] == offset:
+                    found.append(app)
+        return found
+
+    async def read_archived(self):
+        '''archived(), read on the writer thread so the event loop keeps going.'''
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self.archived)
+
+    def ids_by_status(self, *statuses):
+        '''List the request_ids in any of these statuses, from the indexes.
+
+        Unlike by_status(), nothing is read back from the archive.'''
+        found = []
+        for status in statuses:
+            status = to_status(status)
+            if status in ARCHIVED_STATUSES:
+                found += list(self.archive_status_index.get(status, ()))
+            else:
+                found += list(self.status_index.get(status, ()))
+        return found
+
+    async def save(self, app):
+        '''Store an application and wait until its journal entry is on disk.
+
+        Readers see the change at once; the disk write is queued for the
+        writer thread. If the write fails, memory is put back the way it was
+        and the error is raised. Use update() to change an existing
+        application.'''
+        request_id = app.request_id
+        details = app.to_record()
+        saving = [details, self._memory(request_id)]
+        self.inflight.setdefault(request_id, []).append(saving)
+        self._store(app, details)
+        try:
+            await self._submit(request_id, details)
+        except Exception:
+            saves = self.inflight[request_id]
+            i = [id(x) for x in saves].index(id(saving))
+            if i == len(saves) - 1:
+                self._restore(request_id, saving[1])
+            else:
+                # A newer change is still on its way; it must undo to what
+                # was there before this one, which never reached the disk.
+                saves[i + 1][1] = saving[1]
+            raise
+        finally:
+            saves = [x for x in self.inflight[request_id] if x is not saving]
+            self.inflight[request_id] = saves
+            if not saves:
+                del self.inflight[request_id]
+
+    async def update(self, app):
+        '''Save changes made to a copy from get(), as a compare-and-swap.
+
+        The copy carries the version it was read at. If the application has
+        moved on since then, ConflictError is raised and nothing is written.
+        Only this one application is compared, so unrelated applications
+        never get in each other's way.'''
+        current = self.data.get(app.request_id)
+        if current is None:
+            current = self._archive_read(app.request_id)
+        if current is None or current.version != app.version:
+            raise ConflictError(app.request_id)
+        app.version += 1
+        try:
+            await self.save(app)
+        except Exception:
+            app.version -= 1
+            raise
+
+    async def update_many(self, apps):
+        '''update() many copies at once; they reach the disk in one batch.
+
+        Returns the request_ids that conflicted. The others are saved.'''
+        results = await asyncio.gather(*(self.update(app) for app in apps),
+                                       return_exceptions=True)
+        conflicts = []
+        for app, result in zip(apps, results):
+            if isinstance(result, ConflictError):
+                conflicts.append(app.request_id)
+            elif isinstance(result, Exception):
+                raise result
+        return conflicts
+
+    async def _submit(self, request_id, details, expected=None):
+        '''Queue a write for the writer thread and wait for it to finish.'''
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+            self.writer_task = asyncio.ensure_future(self._writer())
+        done = asyncio.get_running_loop().create_future()
+        await self.queue.put((request_id, details, expected, done))
+        await done
+
+    async def _writer(self):
+        '''Write queued entries in batches, one batch at a time.'''
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            while not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            entries = [item[:3] for item in batch]
+            error = None
+            conflicts = ()
+            try:
+                offsets = await loop.run_in_executor(
+                    self.executor, self._append_archive, entries)
+                for request_id, details, _ in entries:
+                    # Unless a newer change is already waiting behind it.
+                    if self.archive_pending.get(request_id) is details:
+                        del self.archive_pending[request_id]
+                        self._archive_put(
+                            Application.from_record(request_id, details),
+                            offsets[request_id])
+                conflicts = await loop.run_in_executor(self.executor,
+                                                       self._write, entries)
+                self.journal_len += len(entries)
+                if self.journal_len >= COMPACT_EVERY:
+                    await loop.run_in_executor(self.executor, self.compact,
+                                               self._snapshot())
+            except Exception as e:
+                logger.error('Failed to write applications: %s', str(e))
+                error = e
+            for i, (request_id, _, _, done) in enumerate(batch):
+                if not done.done():
+                    if error:
+                        done.set_exception(error)
+                    elif i in conflicts:
+                        done.set_exception(ConflictError(request_id))
+                    else:
+                        done.set_result(None)
+                self.queue.task_done()
+
+    def _append_archive(self, entries):
+        '''Append the finished entries to the archive, before the journal.
+
+        Returns the offset each one was written at. Writing the archive first
+        means a finished application in the journal is always in the archive
+        too; a crash in between leaves the older active copy, which wins.'''
+        lines = [(k, encode_line(k, v).encode('utf-8'))
+                 for k, v, _ in entries
+                 if to_status(v.get('status', 'PENDING')) in ARCHIVED_STATUSES]
+        offsets = dict()
+        if not lines:
+            return offsets
+        with open(self.archive_path, mode='ab') as f:
+            offset = f.tell()
+            for request_id, line in lines:
+                offsets[request_id] = offset
+                offset += len(line)
+            f.writelines(line for _, line in lines)
+            f.flush()
+            os.fsync(f.fileno())
+        return offsets
+
+    def _write(self, entries):
+        '''Append journal entries with a single fsync. Runs on the writer thread.
+
+        Versions were already compared in memory, so nothing conflicts here.'''
+        with open(self.path, mode='a') as f:
+            f.writelines(encode_line(k, v) for k, v, _ in entries)
+            f.flush()
+            os.fsync(f.fileno())
+        return ()
+
+    async def close(self):
+        '''Wait for queued writes to reach the disk, then stop the writer.'''
+        if self.queue is not None:
+            await self.queue.join()
+            self.writer_task.cancel()
+        self.executor.shutdown(wait=True)
+
+    def __contains__(self, request_id):
+        request_id = str(request_id)
+        return request_id in self.data or request_id in self.archive
+
+    def __len__(self):
+        return len(self.data) + len(self.archive)
+
+
+class SQLiteStore(ApplicationStore):
+    '''Keep applications in a SQLite database instead of JSON lines.
+
+    Records keep the same dict shape, stored as JSON in the data column,
+    and are read back as Application objects. The columns that commands
+    search by are copied out and indexed, so lookups and counts are indexed
+    queries and closed applications can pile up for years without slowing
+    the hot commands down.'''
+    SCHEMA = (
+        '''CREATE TABLE IF NOT EXISTS applications (
+            request_id TEXT PRIMARY KEY,
+            user_id INTEGER,
+            name TEXT,
+            status TEXT,
+            villager TEXT,
+            last_modified TEXT,
+            data TEXT NOT NULL,
+            version INTEGER NOT NULL DEFAULT 0)''',
+        'CREATE INDEX IF NOT EXISTS idx_user_id ON applications(user_id)',
+        'CREATE INDEX IF NOT EXISTS idx_name ON applications(name)',
+        'CREATE INDEX IF NOT EXISTS idx_status ON applications(status)',
+        # Nothing searches by villager; older databases had it indexed.
+        'DROP INDEX IF EXISTS idx_villager',
+        'CREATE INDEX IF NOT EXISTS idx_last_modified '
+        'ON applications(last_modified)',
+    )
+
+    def __init__(self, path):
+        super().__init__(path)
+        # Commands read through self.conn on the event loop, while the writer
+        # thread owns self.write_conn. WAL lets the two run side by side.
+        self.conn = None
+        self.write_conn = None
+
+    def load(self):
+        '''Open the database in WAL mode and make sure the schema exists.'''
+        self.write_conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.write_conn.execute('PRAGMA journal_mode=WAL')
+        self.write_conn.execute('PRAGMA synchronous=NORMAL')
+        with self.write_conn:
+            self.write_conn.execute(self.SCHEMA[0])
+            columns = [row[1] for row in self.write_conn.execute(
+                'PRAGMA table_info(applications)')]
+            if 'version' not in columns:
+                # Databases migrated before versions were tracked.
+                self.write_conn.execute('ALTER TABLE applications ADD COLUMN '
+                                        'version INTEGER NOT NULL DEFAULT 0')
+            for statement in self.SCHEMA[1:]:
+                self.write_conn.execute(statement)
+        self.conn = sqlite3.connect(self.path)
+
+    def compact(self, snapshot=None):
+        '''Fold the WAL file back into the database.'''
+        self.write_conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        self.journal_len = 0
+
+    def _snapshot(self):
+        return None
+
+    async def close(self):
+        await super().close()
+        self.conn.close()
+        self.write_conn.close()
+
+    def _store(self, app, details):
+        # Nothing is cached in memory; the row is written by _write(). Finished
+        # applications stay in the table, where the status index keeps them
+        # out of the way.
+        pass
+
+    def _append_archive(self, entries):
+        return dict()
+
+    def _row(self, request_id, details):
+        # last_modified is indexed as epoch seconds so it sorts by time.
+        modified = load_time(details.get('last_modified') or
+                             details.get('created_time'))
+        return (str(request_id), details.get('user_id'),
+                normalize_name(details.get('name', '')), details.get('status'),
+                normalize_villager(details.get('villager', '')), modified,
+                json.dumps(details, indent=None), details.get('version', 0))
+
+    def _select(self, where='', params=(), conn=None):
+        # rowid order is insertion order, which an upsert keeps.
+        query = 'SELECT request_id, data FROM applications %s ORDER BY rowid'
+        cursor = (conn or self.conn).execute(query % where, params)
+        return [Application.from_record(k, json.loads(v)) for k, v in cursor]
+
+    async def update(self, app):
+        '''Save changes to a copy from get(), as a compare-and-swap.
+
+        The version is compared by the UPDATE itself on the writer thread.'''
+        expected = app.version
+        app.version += 1
+        try:
+            await self._submit(app.request_id, app.to_record(), expected)
+        except Exception:
+            app.version = expected
+            raise
+
+    def _write(self, entries):
+        '''Write application rows in one transaction on the writer thread.
+
+        Returns the positions of entries whose expected version no longer
+        matched.'''
+        conflicts = []
+        with self.write_conn:
+            for i, (request_id, details, expected) in enumerate(entries):
+                row = self._row(request_id, details)
+                if expected is None:
+                    self.write_conn.execute(
+                        'INSERT INTO applications VALUES (?, ?, ?, ?, ?, ?, ?, ?) '
+                        'ON CONFLICT(request_id) DO UPDATE SET '
+                        'user_id=excluded.user_id, name=excluded.name, '
+                        'status=excluded.status, villager=excluded.villager, '
+                        'last_modified=excluded.last_modified, '
+                        'data=excluded.data, version=excluded.version', row)
+                    continue
+                cursor = self.write_conn.execute(
+                    'UPDATE applications SET user_id=?, name=?, status=?, '
+                    'villager=?, last_modified=?, data=?, version=? '
+                    'WHERE request_id=? AND version=?',
+                    row[1:] + (request_id, expected))
+                if not cursor.rowcount:
+                    conflicts.append(i)
+        return conflicts
+
+    def import_records(self, records):
+        '''Copy every application of another store over in one transaction.'''
+        with self.write_conn:
+            self.write_conn.executemany(
+                'INSERT OR REPLACE INTO applications VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [self._row(app.request_id, app.to_record())
+                 for app in records.all() + records.archived()])
+
+    def get(self, request_id):
+        found = self._select('WHERE request_id = ?', (str(request_id),))
+        return found[0] if found else None
+
+    def _active(self, where='', params=()):
+        # Limit a query to applications that are not finished.
+        names = [status.name for status in ARCHIVED_STATUSES]
+        clause = 'status NOT IN (%s)' % ', '.join('?' * len(names))
+        where = '%s AND %s' % (where, clause) if where else 'WHERE ' + clause
+        return where, tuple(params) + tuple(names)
+
+    def all(self):
+        return self._select(*self._active())
+
+    def archived(self, conn=None):
+        names = [status.name for status in ARCHIVED_STATUSES]
+        marks = ', '.join('?' * len(names))
+        return self._select('WHERE status IN (%s)' % marks, names, conn)
+
+    async def _read(self, func, *args):
+        # self.conn belongs to the event loop's thread; the writer thread
+        # reads through its own connection.
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, lambda: func(*args, conn=self.write_conn))
+
+    async def read_archived(self):
+        return await self._read(self.archived)
+
+    def ids_by_status(self, *statuses):
+        marks = ', '.join('?' * len(statuses))
+        names = [to_status(status).name for status in statuses]
+        cursor = self.conn.execute('SELECT request_id FROM applications '
+                                   'WHERE status IN (%s) ORDER BY rowid'
+                                   % marks, names)
+        return [request_id for (request_id,) in cursor]
+
+    def by_user(self, user_id, archived=False, conn=None):
+        if archived:
+            return self._select('WHERE user_id = ?', (user_id,), conn)
+        return self._select(*self._active('WHERE user_id = ?', (user_id,)),
+                            conn)
+
+    async def read_by_user(self, user_id):
+        return await self._read(self.by_user, user_id, True)
+
+    def by_status(self, *statuses, conn=None):
+        marks = ', '.join('?' * len(statuses))
+        names = [to_status(status).name for status in statuses]
+        return self._select('WHERE status IN (%s)' % marks, names, conn)
+
+    async def read_by_status(self, *statuses):
+        return await self._read(self.by_status, *statuses)
+
+    def by_name(self, name):
+        return self._select(*self._active('WHERE name = ?',
+                                          (normalize_name(name),)))
+
+    def search_name(self, pattern, conn=None):
+        # The distinct names come off the name index; only matches are read.
+        names = [n for (n,) in (conn or self.conn).execute(
+                     'SELECT DISTINCT name FROM applications')
+                 if re.search(pattern, n, re.IGNORECASE)]
+        if not names:
+            return []
+        marks = ', '.join('?' * len(names))
+        return self._select('WHERE name IN (%s)' % marks, names, conn)
+
+    async def read_search_name(self, pattern):
+        return await self._read(self.search_name, pattern)
+
+    def count(self, status):
+        query = 'SELECT COUNT(*) FROM applications WHERE status = ?'
+        return self.conn.execute(query, (to_status(status).name,)).fetchone()[0]
+
+    def __contains__(self, request_id):
+        query = 'SELECT 1 FROM applications WHERE request_id = ?'
+        return self.conn.execute(query, (str(request_id),)).fetchone() is not None
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM applications').fetchone()[0]
+
+
+def open_store(path, snapshot_path=None, archive_path=None):
+    '''Pick a store by the RECORD_FILE extension: SQLite or JSON lines.'''
+    if str(path).endswith(('.db', '.sqlite', '.sqlite3')):
+        return SQLiteStore(path)
+    return ApplicationStore(path, snapshot_path, archive_path)
+
+
+def migrate(record_file, db_file):
+    '''One-shot import of a record.txt (its snapshot and archive) into SQLite.'''
+    source = ApplicationStore(record_file)
+    source.load()
+    target = SQLiteStore(db_file)
+    target.load()
+    target.import_records(source)
+    return len(source)
+
+
+records = open_store(RECORD_FILE, SNAPSHOT_FILE, ARCHIVE_FILE)
+
+
+if __name__ == '__main__':
+    # Usage: python -m ext.store migrate record.txt record.db
+    if len(sys.argv) != 4 or sys.argv[1] != 'migrate':
+        sys.exit('Usage: python -m ext.store migrate <record.txt> <record.db>')
+    print('Imported %d applications.' % migrate(sys.argv[2], sys.argv[3]))
@@ -2,12 +2,9 @@
 # Note: secrets module is in Python 3.6+.
 import datetime
 from enum import Enum
-import json
-import os
 import random
 import secrets
 import string
-import time
 
 import discord
 from discord.ext import commands
@@ -16,8 +13,6 @@ from dotenv import load_dotenv
 from ext import auth_config
 
 load_dotenv()
-# Sitting in the parent directory where bot.py runs.
-RECORD_FILE = os.getenv('RECORD_FILE')
 
 
 class Status(Enum):
@@ -46,32 +41,12 @@ class Status(Enum):
     # An application is rejected due to lack of community activities.
     REJECTED = 8
 
-def open_requestlog():
-    # Open request log file.
-    data_dict = dict()
-    with open(RECORD_FILE) as f:
-        # data_dict is keyed by request_id, and its value contains the rest data.
-        for line in f:
-            line_dict = json.loads(line.rstrip())
-            data_dict[list(line_dict)[0]] = list(line_dict.values())[0]
-    return data_dict
-
-
-def flush_requestlog(data):
-    '''Use this function to write modified data back.'''
-    os.remove(RECORD_FILE)
-    time.sleep(1)
-    with open(RECORD_FILE, mode='a') as f:
-        for d in list(data.items()):
-            tmp_dict = dict()
-            tmp_dict[d[0]] = d[1]
-            json.dump(tmp_dict, f, indent=None)
-            f.write('\n')
-
 
 def printadict(data_dict, hide_self=False):
     '''Convert a dictionary into a printable string.'''
     data = data_dict.copy()
+    # The store's version counter means nothing to a reader.
+    data.pop('version', None)
     if hide_self:
         # when a user has multiple requests, hide these repeated information
         # Or anything we don't want users to see.
@@ -80,6 +55,8 @@ def printadict(data_dict, hide_self=False):
             del data['user_id']
         except KeyError as e:
             print('printadict errors: %s', str(e))
+        # Staff notes are not for applicants.
+        data.pop('notes', None)
 
     # return json.dumps(data, indent=2)
     tmp = []
@@ -131,6 +108,11 @@ def genreport(data_dict, criteria=None):
     return table_dict
 
 
+def brief(app):
+    '''One line about an application, as status reports list it.'''
+    return '**{}** looks for _{}_'.format(app.name, app.villager_name)
+
+
 def get_embed(color, text, title=None):
     '''Get an embedded object to send via bot.'''
     # For a finished adoption request. Usually it will be closed.
@@ -165,6 +147,53 @@ def get_embed(color, text, title=None):
     return em
 
 
+# Discord rejects embeds over these limits.
+EMBED_FIELDS = 25
+EMBED_CHARS = 6000
+FIELD_NAME_CHARS = 256
+FIELD_VALUE_CHARS = 1024
+
+
+def build_embeds(title, fields, description=None, color=None):
+    '''Embeds listing fields, split over as many as Discord's limits need.
+
+    fields are (name, value) pairs. Every embed gets the title, numbered
+    like "(1/3)" when there are more, and the same color; the description
+    goes on the first one.'''
+    color = color or random_color()
+    # Room for the title with its page number, and the description.
+    base = len(title) + len(' (99/99)') + len(description or '')
+    pages = [[]]
+    size = base
+    for name, value in fields:
+        name = str(name)[:FIELD_NAME_CHARS] or '-'
+        value = str(value)[:FIELD_VALUE_CHARS] or '-'
+        if (len(pages[-1]) == EMBED_FIELDS or
+                size + len(name) + len(value) > EMBED_CHARS):
+            pages.append([])
+            size = base
+        pages[-1].append((name, value))
+        size += len(name) + len(value)
+    embeds = []
+    for i, page in enumerate(pages, start=1):
+        embed = discord.Embed(title=title)
+        if len(pages) > 1:
+            embed.title = '%s (%d/%d)' % (title, i, len(pages))
+        if description and i == 1:
+            embed.description = description
+        embed.color = color
+        for name, value in page:
+            embed.add_field(name=name, value=value, inline=True)
+        embeds.append(embed)
+    return embeds
+
+
+async def send_embeds(channel, embeds):
+    '''Send embeds from build_embeds(), one message each.'''
+    for embed in embeds:
+        await channel.send(embed=embed)
+
+
 def status_color(data):
     '''Select embed color by the status of a data dictionary.'''
     # default = gray. status=PENDING 